@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""
+Autotuning della lunghezza dei chunk e della concorrenza per ogni motore.
+
+Ogni tentativo di trascrizione viene registrato (durata del chunk, chiamate
+in corso sullo stesso motore, latenza, esito). Da queste osservazioni
+l'Autotuner stima per ogni motore:
+
+- la latenza di un tentativo: latency = a + b * durata_chunk + c * (in_corso - 1),
+  con una regressione ridge verso valori a priori, così funziona anche con
+  pochi o nessun campione;
+- la probabilità di errore per livello di concorrenza, con un prior Beta.
+
+Per un audio di durata D sceglie la lunghezza dei chunk e il numero di chunk
+in parallelo che minimizzano il tempo atteso più il costo delle chiamate:
+
+    gruppi * latenza_attesa_con_retry + (gruppi - 1) * pausa_tra_gruppi
+    + chunk * chiamate_per_chunk * AUTOTUNE_CHUNK_COST_S
+
+Un audio non più lungo del chunk di partenza (CHUNK_DURATION_MS) non viene
+mai diviso, e i chunk in parallelo non superano gli slot della corsia normale
+dello scheduler. chunking_plan() è il punto d'ingresso comune al bot e al dry-run.
+
+Le osservazioni vengono salvate su disco (AUTOTUNE_STATE_PATH) a fine file,
+mai dall'observer, e ricaricate al riavvio. Il salvataggio unisce le nuove
+osservazioni a quelle già su disco sotto un lock, così più processi (es. i
+worker di batch_transcribe.py) possono condividere lo stesso file.
+
+Dry-run, per vedere il piano scelto per un audio di un'ora:
+    python autotune.py --duration 3600 --engine google-legacy
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Deque, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo il lock tra thread dello stesso processo
+    fcntl = None
+
+from logging_config import setup_logger
+from resilience import RETRY_BACKOFF_BASE_S
+from scheduler import SCHEDULER
+
+# Configurazione del logger
+logger = setup_logger(__name__)
+
+AUTOTUNE_ENABLED = os.getenv("AUTOTUNE", "true").lower() in ("1", "true", "yes")
+AUTOTUNE_STATE_PATH = Path(os.getenv("AUTOTUNE_STATE_PATH", "storage/autotune.json"))
+# Probabilità di scegliere un piano quasi ottimo invece dell'ottimo, per
+# continuare a raccogliere osservazioni su lunghezze diverse (solo per audio
+# più lunghi del chunk di partenza)
+AUTOTUNE_EXPLORE = float(os.getenv("AUTOTUNE_EXPLORE", "0"))
+# Costo di ogni chiamata al servizio (quota, fatturazione), in secondi di attesa equivalenti
+AUTOTUNE_CHUNK_COST_S = float(os.getenv("AUTOTUNE_CHUNK_COST_S", "2"))
+AUTOTUNE_MAX_CONCURRENCY = int(os.getenv("AUTOTUNE_MAX_CONCURRENCY", os.getenv("SCHEDULER_MAX_CONCURRENCY", "8")))
+AUTOTUNE_WINDOW = 1000
+
+# Costanti per la gestione dell'audio
+# Valori di partenza: con AUTOTUNE attivo lunghezza dei chunk e dimensione dei
+# gruppi vengono scelte dall'autotuner in base alle latenze osservate
+CHUNK_DURATION_MS = 60 * 1000
+OVERLAP_DURATION_MS = 3 * 1000
+GROUP_SIZE = 8
+GROUP_PAUSE_S = 15
+
+CANDIDATE_CHUNK_SECONDS = (20, 30, 45, 60, 90, 120, 180, 300, 600)
+BASELINE_CHUNK_S = CHUNK_DURATION_MS / 1000
+# Lunghezza massima di un chunk accettata da ciascun motore
+ENGINE_MAX_CHUNK_S = {
+    "google-legacy": 60,
+    "azure": 60,
+    "gemini": 600,
+    "fake": 600,
+}
+# Chiamate remote per chunk: google-legacy aggiunge la punteggiatura con Gemini
+ENGINE_CALLS_PER_CHUNK = {
+    "google-legacy": 2,
+}
+# Coefficienti a priori (a, b, c) della latenza per motore
+ENGINE_LATENCY_PRIORS = {
+    "google-legacy": (3.0, 0.15, 0.5),
+    "gemini": (4.0, 0.05, 0.5),
+}
+DEFAULT_LATENCY_PRIOR = (3.0, 0.1, 0.5)
+PRIOR_WEIGHT = 1.0
+# Prior Beta(alpha, beta) della probabilità di errore di un tentativo
+ERROR_PRIOR = (0.5, 10.0)
+MAX_ERROR_RATE = 0.95
+
+
+class TuningPlan(NamedTuple):
+    chunk_s: float
+    overlap_s: float
+    concurrency: int
+    n_chunks: int
+    expected_wall_s: float
+    cost_s: float = 0.0
+
+
+def count_chunks(duration_s: float, chunk_s: float, overlap_s: float) -> int:
+    """Numero di chunk prodotti da split_audio_file per un audio di durata data."""
+    if duration_s <= chunk_s:
+        return 1
+    return math.ceil((duration_s - chunk_s) / (chunk_s - overlap_s)) + 1
+
+
+def _solve(matrix: List[List[float]], vector: List[float]) -> List[float]:
+    """Risolve un piccolo sistema lineare con eliminazione di Gauss."""
+    n = len(vector)
+    rows = [row[:] + [value] for row, value in zip(matrix, vector)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(rows[r][col]))
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in range(n):
+            if r != col and rows[col][col]:
+                factor = rows[r][col] / rows[col][col]
+                rows[r] = [x - factor * y for x, y in zip(rows[r], rows[col])]
+    return [rows[i][n] / rows[i][i] for i in range(n)]
+
+
+class EngineStats:
+    """Osservazioni di un motore e modello di latenza ed errori che ne deriva."""
+
+    def __init__(self, name: str, samples: Sequence[Sequence[float]] = ()):
+        self.name = name
+        self.samples: Deque[Tuple[float, int, float, bool]] = deque(
+            (tuple(s) for s in samples), maxlen=AUTOTUNE_WINDOW
+        )
+
+    def record(self, chunk_s: float, in_flight: int, latency_s: float, ok: bool):
+        self.samples.append((chunk_s, in_flight, latency_s, ok))
+
+    def latency_model(self) -> Tuple[float, float, float]:
+        """Coefficienti (a, b, c) stimati con regressione ridge verso il prior."""
+        prior = ENGINE_LATENCY_PRIORS.get(self.name, DEFAULT_LATENCY_PRIOR)
+        xtx = [[PRIOR_WEIGHT if i == j else 0.0 for j in range(3)] for i in range(3)]
+        xty = [PRIOR_WEIGHT * p for p in prior]
+        for chunk_s, in_flight, latency_s, ok in self.samples:
+            if not ok:
+                continue
+            x = (1.0, chunk_s, max(in_flight - 1, 0))
+            for i in range(3):
+                xty[i] += x[i] * latency_s
+                for j in range(3):
+                    xtx[i][j] += x[i] * x[j]
+        a, b, c = _solve(xtx, xty)
+        return max(a, 0.0), max(b, 0.0), max(c, 0.0)
+
+    def error_rates(self, max_concurrency: int) -> Dict[int, float]:
+        """Probabilità di errore per concorrenza da 1 a max_concurrency (monotona non decrescente)."""
+        alpha, beta = ERROR_PRIOR
+        counts: Dict[int, List[int]] = {}
+        for _, in_flight, _, ok in self.samples:
+            bucket = counts.setdefault(in_flight, [0, 0])
+            bucket[0] += 0 if ok else 1
+            bucket[1] += 1
+        rates = {}
+        rate = alpha / (alpha + beta)
+        seen = False
+        for concurrency in range(1, max_concurrency + 1):
+            if concurrency in counts:
+                errors, total = counts[concurrency]
+                estimate = (errors + alpha) / (total + alpha + beta)
+                rate = estimate if not seen else max(rate, estimate)
+                seen = True
+            rates[concurrency] = min(rate, MAX_ERROR_RATE)
+        return rates
+
+    def error_rate(self, concurrency: int) -> float:
+        """Probabilità di errore a una data concorrenza."""
+        return self.error_rates(concurrency)[concurrency]
+
+    def expected_latency(self, chunk_s: float, concurrency: int) -> float:
+        a, b, c = self.latency_model()
+        return a + b * chunk_s + c * (concurrency - 1)
+
+
+class Autotuner:
+    """
+    Registra le osservazioni dei motori e sceglie il piano di chunking.
+
+    Args:
+        state_path: File JSON in cui persistere le osservazioni
+        max_concurrency: Massimo numero di chunk in parallelo da considerare
+        explore: Probabilità di esplorare un piano quasi ottimo
+    """
+
+    def __init__(
+        self,
+        state_path: Path = AUTOTUNE_STATE_PATH,
+        max_concurrency: int = AUTOTUNE_MAX_CONCURRENCY,
+        explore: float = AUTOTUNE_EXPLORE,
+    ):
+        self.state_path = Path(state_path)
+        self.max_concurrency = max_concurrency
+        self.explore = explore
+        self.engines: Dict[str, EngineStats] = {}
+        self._random = random.Random()
+        # Osservazioni non ancora scritte su disco, per motore
+        self._unsaved: Dict[str, List[Tuple[float, int, float, bool]]] = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self.load()
+
+    def stats(self, engine: str) -> EngineStats:
+        if engine not in self.engines:
+            self.engines[engine] = EngineStats(engine)
+        return self.engines[engine]
+
+    def record(self, engine: str, chunk_s: Optional[float], latency_s: float, ok: bool, in_flight: int = 1):
+        """Registra un tentativo; compatibile con l'observer di ResilientEngine."""
+        if chunk_s is None:
+            return
+        with self._lock:
+            self.stats(engine).record(chunk_s, in_flight, latency_s, ok)
+            self._unsaved.setdefault(engine, []).append((chunk_s, in_flight, latency_s, ok))
+
+    def candidate_plans(
+        self, engine: str, duration_s: float, overlap_s: float, group_pause_s: float,
+        backoff_s: float = 1.0, max_chunk_s: Optional[float] = None,
+        baseline_chunk_s: float = BASELINE_CHUNK_S, max_concurrency: Optional[int] = None,
+    ) -> List[TuningPlan]:
+        """Tutti i piani ammessi per il motore, ordinati per tempo atteso più costo."""
+        stats = self.stats(engine)
+        if max_concurrency is None:
+            max_concurrency = self.max_concurrency
+        max_concurrency = max(1, min(max_concurrency, self.max_concurrency))
+        if max_chunk_s is None:
+            max_chunk_s = ENGINE_MAX_CHUNK_S.get(engine, 60)
+        baseline_chunk_s = min(baseline_chunk_s, max_chunk_s)
+        if duration_s <= baseline_chunk_s:
+            # Una nota breve va sempre in un'unica chiamata
+            lengths = [baseline_chunk_s]
+        else:
+            lengths = [s for s in CANDIDATE_CHUNK_SECONDS if overlap_s < s <= max_chunk_s] or [max_chunk_s]
+        # Modello stimato una sola volta per piano, non per ogni candidato
+        a, b, c = stats.latency_model()
+        error_rates = stats.error_rates(max_concurrency)
+        call_cost_s = ENGINE_CALLS_PER_CHUNK.get(engine, 1) * AUTOTUNE_CHUNK_COST_S
+        plans = []
+        for chunk_s in lengths:
+            n_chunks = count_chunks(duration_s, chunk_s, overlap_s)
+            for concurrency in range(1, max_concurrency + 1):
+                if concurrency > n_chunks:
+                    break
+                # Tentativi attesi per chunk (geometrica) e attese di backoff tra un tentativo e l'altro
+                attempts = 1 / (1 - error_rates[concurrency])
+                chunk_time = attempts * (a + b * min(chunk_s, duration_s) + c * (concurrency - 1))
+                chunk_time += (attempts - 1) * backoff_s
+                groups = math.ceil(n_chunks / concurrency)
+                wall_s = groups * chunk_time + (groups - 1) * group_pause_s
+                cost_s = n_chunks * attempts * call_cost_s
+                plans.append(TuningPlan(chunk_s, overlap_s, concurrency, n_chunks, wall_s, cost_s))
+        plans.sort(key=lambda plan: plan.expected_wall_s + plan.cost_s)
+        return plans
+
+    def plan(
+        self, engine: str, duration_s: float, overlap_s: float, group_pause_s: float,
+        backoff_s: float = 1.0, max_chunk_s: Optional[float] = None, explore: Optional[float] = None,
+        baseline_chunk_s: float = BASELINE_CHUNK_S, max_concurrency: Optional[int] = None,
+    ) -> TuningPlan:
+        """Sceglie il piano migliore (o, con probabilità explore, uno dei successivi)."""
+        plans = self.candidate_plans(
+            engine, duration_s, overlap_s, group_pause_s, backoff_s, max_chunk_s, baseline_chunk_s, max_concurrency
+        )
+        explore = self.explore if explore is None else explore
+        if len(plans) > 1 and duration_s > baseline_chunk_s and self._random.random() < explore:
+            return self._random.choice(plans[1:3])
+        return plans[0]
+
+    def _read_state(self) -> Dict[str, List]:
+        if not self.state_path.exists():
+            return {}
+        return json.loads(self.state_path.read_text(encoding="utf-8"))["engines"]
+
+    def load(self):
+        try:
+            engines = self._read_state()
+        except Exception as e:
+            logger.warning(f"Impossibile caricare lo stato dell'autotuner da {self.state_path}: {e}")
+            return
+        if engines:
+            self.engines = {name: EngineStats(name, samples) for name, samples in engines.items()}
+            logger.info(f"Stato dell'autotuner caricato da {self.state_path}")
+
+    def save(self):
+        """
+        Aggiunge le osservazioni nuove a quelle su disco e ricarica il risultato,
+        che include anche quelle salvate nel frattempo da altri processi.
+        Da chiamare fuori dal loop asincrono (es. con asyncio.to_thread).
+        """
+        with self._save_lock:
+            with self._lock:
+                unsaved, self._unsaved = self._unsaved, {}
+            if not unsaved:
+                return
+            temp_name = None
+            try:
+                self.state_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.state_path.with_name(self.state_path.name + ".lock"), "a") as lock_file:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    try:
+                        engines = self._read_state()
+                    except Exception as e:
+                        logger.warning(f"Stato dell'autotuner illeggibile in {self.state_path}, lo riscrivo: {e}")
+                        engines = {}
+                    for name, samples in unsaved.items():
+                        engines[name] = (engines.get(name, []) + [list(s) for s in samples])[-AUTOTUNE_WINDOW:]
+                    with tempfile.NamedTemporaryFile(
+                        "w", encoding="utf-8", dir=self.state_path.parent,
+                        prefix=f".{self.state_path.name}.", suffix=".tmp", delete=False,
+                    ) as temp_file:
+                        temp_name = temp_file.name
+                        json.dump({"engines": engines}, temp_file)
+                    os.replace(temp_name, self.state_path)
+            except Exception as e:
+                logger.warning(f"Impossibile salvare lo stato dell'autotuner in {self.state_path}: {e}")
+                if temp_name and os.path.exists(temp_name):
+                    os.unlink(temp_name)
+                with self._lock:
+                    for name, samples in unsaved.items():
+                        self._unsaved[name] = samples + self._unsaved.get(name, [])
+                return
+            with self._lock:
+                # Le osservazioni arrivate durante il salvataggio restano in coda
+                for name, samples in engines.items():
+                    self.engines[name] = EngineStats(name, samples + [list(s) for s in self._unsaved.get(name, [])])
+
+
+# Autotuner condiviso dal processo
+AUTOTUNER = Autotuner()
+
+
+def plan_options(
+    engine: str, fallback_engine: Optional[str] = None, max_concurrency: Optional[int] = None,
+    backoff_s: float = RETRY_BACKOFF_BASE_S,
+) -> Dict:
+    """Parametri di Autotuner.plan/candidate_plans per un motore ed eventuale fallback."""
+    # Con un fallback i chunk devono andare bene per entrambi i motori
+    max_chunk_s = ENGINE_MAX_CHUNK_S.get(engine, BASELINE_CHUNK_S)
+    if fallback_engine:
+        max_chunk_s = min(max_chunk_s, ENGINE_MAX_CHUNK_S.get(fallback_engine, BASELINE_CHUNK_S))
+    return {
+        "overlap_s": OVERLAP_DURATION_MS / 1000,
+        "group_pause_s": GROUP_PAUSE_S,
+        "backoff_s": backoff_s,
+        "max_chunk_s": max_chunk_s,
+        "baseline_chunk_s": BASELINE_CHUNK_S,
+        "max_concurrency": max_concurrency,
+    }
+
+
+def chunking_plan(
+    engine: str, duration_s: float, fallback_engine: Optional[str] = None,
+    max_concurrency: Optional[int] = None, backoff_s: float = RETRY_BACKOFF_BASE_S,
+) -> TuningPlan:
+    """
+    Piano di chunking per un audio: scelto dall'autotuner se AUTOTUNE è attivo,
+    altrimenti con le costanti CHUNK_DURATION_MS e GROUP_SIZE.
+
+    Args:
+        engine: Motore di trascrizione principale
+        duration_s: Durata dell'audio in secondi
+        fallback_engine: Motore di fallback, i cui limiti valgono anche per i chunk
+        max_concurrency: Chunk in parallelo concessi dallo scheduler a un job lungo
+        backoff_s: Attesa media prima di un retry
+    """
+    if not AUTOTUNE_ENABLED:
+        chunk_s = CHUNK_DURATION_MS / 1000
+        overlap_s = OVERLAP_DURATION_MS / 1000
+        concurrency = GROUP_SIZE if max_concurrency is None else max(1, min(GROUP_SIZE, max_concurrency))
+        return TuningPlan(chunk_s, overlap_s, concurrency, count_chunks(duration_s, chunk_s, overlap_s), float("nan"))
+    options = plan_options(engine, fallback_engine, max_concurrency, backoff_s)
+    return AUTOTUNER.plan(engine, duration_s, **options)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dry-run dell'autotuner: mostra il piano per una durata audio")
+    parser.add_argument("--duration", type=float, required=True, help="Durata dell'audio in secondi")
+    parser.add_argument("--engine", default=os.getenv("TRANSCRIPTION_ENGINE", "google-legacy"))
+    parser.add_argument("--fallback", default=os.getenv("TRANSCRIPTION_FALLBACK_ENGINE"), help="Motore di fallback")
+    parser.add_argument("--top", type=int, default=5, help="Numero di piani alternativi da mostrare")
+    args = parser.parse_args()
+
+    # Stessi parametri del bot: slot della corsia normale dello scheduler
+    max_concurrency = SCHEDULER.normal_lane_slots
+    best = chunking_plan(args.engine, args.duration, args.fallback, max_concurrency)
+    if not AUTOTUNE_ENABLED:
+        print(
+            f"AUTOTUNE disattivato: chunk da {best.chunk_s:.0f}s, {best.concurrency} in parallelo, "
+            f"{best.n_chunks} chunk"
+        )
+        return
+
+    stats = AUTOTUNER.stats(args.engine)
+    a, b, c = stats.latency_model()
+    print(f"Motore: {args.engine} ({len(stats.samples)} osservazioni in {AUTOTUNER.state_path})")
+    print(f"Modello di latenza: {a:.2f}s + {b:.3f}s per secondo di audio + {c:.2f}s per chiamata concorrente")
+    plans = AUTOTUNER.candidate_plans(
+        args.engine, args.duration, **plan_options(args.engine, args.fallback, max_concurrency)
+    )
+    print(
+        f"Piano scelto per {args.duration:.0f}s di audio: chunk da {best.chunk_s:.0f}s, "
+        f"{best.concurrency} in parallelo, {best.n_chunks} chunk, tempo atteso {best.expected_wall_s:.1f}s "
+        f"(+{best.cost_s:.1f}s di costo delle chiamate)"
+    )
+    print("Alternative:")
+    for plan in [p for p in plans if p != best][:args.top]:
+        print(
+            f"  chunk {plan.chunk_s:.0f}s x {plan.concurrency} in parallelo "
+            f"({plan.n_chunks} chunk): {plan.expected_wall_s:.1f}s + {plan.cost_s:.1f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Trascrizione offline di archivi di registrazioni, senza passare da Telegram.
+
+I file (cartelle, glob o singoli percorsi, in qualsiasi formato supportato da
+ffmpeg) vengono distribuiti su un pool di processi; ogni processo trascrive
+un file alla volta con la pipeline asincrona del bot, con un proprio limite di
+chunk in parallelo. I risultati vengono scritti man mano in JSONL o Parquet e
+un manifest tiene traccia dei file completati, così un'esecuzione interrotta
+riprende da dove si era fermata.
+
+Esempi:
+    python batch_transcribe.py archivio/ "registrazioni/**/*.m4a" -o risultati.jsonl
+    python batch_transcribe.py archivio/ -o risultati.parquet --workers 4 --chunk-concurrency 8
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import glob
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Set
+
+from dotenv import load_dotenv
+from logging_config import setup_logger
+
+# Configurazione del logger
+logger = setup_logger(__name__)
+
+try:
+    load_dotenv()
+except Exception as e:
+    logger.error(f"Errore nel caricamento del file .env: {e}", exc_info=True)
+
+AUDIO_EXTENSIONS = {
+    ".wav", ".ogg", ".oga", ".opus", ".mp3", ".m4a", ".aac", ".flac",
+    ".wma", ".amr", ".webm", ".mp4", ".mkv", ".mov", ".aiff", ".aif",
+}
+PARQUET_BUFFER_SIZE = 50
+
+
+def find_audio_files(inputs: Iterable[str], extensions=AUDIO_EXTENSIONS) -> List[Path]:
+    """Espande cartelle (ricorsivamente), glob e percorsi in una lista ordinata di file audio."""
+    files = set()
+    for item in inputs:
+        matches = [Path(p) for p in glob.glob(item, recursive=True)] or [Path(item)]
+        for match in matches:
+            if match.is_dir():
+                files.update(p for p in match.rglob("*") if p.is_file() and p.suffix.lower() in extensions)
+            elif match.is_file():
+                files.add(match)
+            else:
+                logger.warning(f"Percorso non trovato: {item}")
+    return sorted(p.resolve() for p in files)
+
+
+def file_fingerprint(path: Path) -> Dict:
+    stat = path.stat()
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+class Manifest:
+    """
+    Registro su disco dei file già elaborati, aggiornato in modo atomico.
+
+    Un file è considerato completato se è segnato "done" e non è cambiato
+    (stessa dimensione e data di modifica) dall'ultima elaborazione.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries: Dict[str, Dict] = {}
+        if path.exists():
+            self.entries = json.loads(path.read_text(encoding="utf-8"))
+
+    def is_done(self, file_path: Path) -> bool:
+        entry = self.entries.get(str(file_path))
+        return bool(entry and entry["status"] == "done" and entry["fingerprint"] == file_fingerprint(file_path))
+
+    def mark(self, file_path: Path, status: str, error: str = None):
+        self.entries[str(file_path)] = {
+            "status": status,
+            "fingerprint": file_fingerprint(file_path),
+            "error": error,
+            "updated_at": datetime.now().isoformat(timespec="seconds"),
+        }
+
+    def save(self):
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        temp_path.write_text(json.dumps(self.entries, indent=1, ensure_ascii=False), encoding="utf-8")
+        os.replace(temp_path, self.path)
+
+
+class JsonlWriter:
+    """Scrive un record per riga, con flush immediato."""
+
+    def __init__(self, path: Path):
+        self._path = path
+        self._file = open(path, "a", encoding="utf-8")
+
+    def existing_paths(self) -> Set[str]:
+        """Percorsi già presenti nell'output (anche se il manifest non li segna)."""
+        paths = set()
+        with open(self._path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    paths.add(json.loads(line)["path"])
+                except (ValueError, KeyError):
+                    # Riga troncata da un'interruzione durante la scrittura
+                    continue
+        return paths
+
+    def discard(self, paths: Set[str]):
+        """Elimina dall'output i record dei percorsi indicati (riscrivendo il file)."""
+        self._file.close()
+        temp_path = self._path.with_name(self._path.name + ".tmp")
+        with open(self._path, encoding="utf-8") as source, open(temp_path, "w", encoding="utf-8") as target:
+            for line in source:
+                try:
+                    if json.loads(line)["path"] in paths:
+                        continue
+                except (ValueError, KeyError):
+                    continue
+                target.write(line)
+            target.flush()
+            os.fsync(target.fileno())
+        os.replace(temp_path, self._path)
+        self._file = open(self._path, "a", encoding="utf-8")
+
+    def write(self, record: Dict) -> bool:
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return True
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    """
+    Scrive i record nella cartella di output, un file Parquet completo ogni
+    PARQUET_BUFFER_SIZE record. Un file Parquet è leggibile solo dopo la
+    chiusura (footer), quindi ogni file viene scritto a parte e rinominato al
+    suo posto prima che il manifest segni i relativi record come completati.
+    """
+
+    def __init__(self, path: Path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("L'output Parquet richiede pyarrow: pip install pyarrow")
+        self._pa = pa
+        self._pq = pq
+        path.mkdir(parents=True, exist_ok=True)
+        self._dir = path
+        self._prefix = f"part-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}"
+        self._parts = 0
+        self._buffer: List[Dict] = []
+
+    def existing_paths(self) -> Set[str]:
+        """Percorsi già presenti nei file Parquet dell'output."""
+        paths = set()
+        for part in self._dir.glob("part-*.parquet"):
+            try:
+                paths.update(self._pq.read_table(str(part), columns=["path"]).column("path").to_pylist())
+            except Exception as e:
+                logger.warning(f"File Parquet illeggibile ignorato: {part} ({e})")
+        return paths
+
+    def discard(self, paths: Set[str]):
+        """Elimina dall'output i record dei percorsi indicati (riscrivendo i file coinvolti)."""
+        for part in self._dir.glob("part-*.parquet"):
+            try:
+                table = self._pq.read_table(str(part))
+            except Exception:
+                continue
+            keep = [path not in paths for path in table.column("path").to_pylist()]
+            if all(keep):
+                continue
+            if not any(keep):
+                part.unlink()
+                continue
+            temp_path = part.with_name(part.name + ".tmp")
+            self._pq.write_table(table.filter(self._pa.array(keep)), str(temp_path))
+            os.replace(temp_path, part)
+
+    def write(self, record: Dict) -> bool:
+        """Aggiunge un record; restituisce True quando i record in buffer sono su disco."""
+        self._buffer.append(record)
+        if len(self._buffer) < PARQUET_BUFFER_SIZE:
+            return False
+        self.flush()
+        return True
+
+    def flush(self):
+        if not self._buffer:
+            return
+        self._parts += 1
+        part_path = self._dir / f"{self._prefix}-{self._parts:05d}.parquet"
+        temp_path = part_path.with_name(part_path.name + ".tmp")
+        self._pq.write_table(self._pa.Table.from_pylist(self._buffer), str(temp_path))
+        os.replace(temp_path, part_path)
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+
+
+def init_worker(chunk_concurrency: int):
+    """Configura lo scheduler del processo prima che helpers venga importato."""
+    os.environ["SCHEDULER_MAX_CONCURRENCY"] = str(chunk_concurrency)
+    os.environ["SCHEDULER_FAST_LANE_SLOTS"] = "0"
+    import helpers  # noqa: F401
+
+
+def transcribe_file(path: str) -> Dict:
+    """Trascrive un file nel processo worker e restituisce il record di output."""
+    from helpers import convert_audio_to_wav, get_wav_duration, transcribe_audio_chunks_async, FAILED_CHUNK_MARKER
+
+    start_time = time.time()
+    record = {"path": path, "duration_s": None, "text": None, "failed_chunks": 0, "elapsed_s": None, "error": None}
+    wav_path = None
+    try:
+        wav_path = convert_audio_to_wav(path)
+        record["duration_s"] = get_wav_duration(wav_path)
+        text = asyncio.run(transcribe_audio_chunks_async(wav_path)).text
+        record["text"] = text
+        record["failed_chunks"] = text.count(FAILED_CHUNK_MARKER.split("{")[0])
+    except Exception as e:
+        logger.error(f"Errore durante la trascrizione di {path}: {e}", exc_info=True)
+        record["error"] = str(e)
+    finally:
+        if wav_path:
+            try:
+                os.unlink(wav_path)
+            except OSError:
+                pass
+    record["elapsed_s"] = time.time() - start_time
+    return record
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trascrizione offline di archivi audio")
+    parser.add_argument("inputs", nargs="+", help="Cartelle, glob o file audio")
+    parser.add_argument("-o", "--output", required=True, help="File .jsonl o cartella/file .parquet")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], help="Default: dedotto dall'estensione di output")
+    parser.add_argument("--manifest", help="Manifest per la ripresa (default: <output>.manifest.json)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processi in parallelo")
+    parser.add_argument("--chunk-concurrency", type=int, default=4, help="Chunk in parallelo per processo")
+    args = parser.parse_args()
+
+    output = Path(args.output)
+    output_format = args.format or ("parquet" if output.suffix == ".parquet" else "jsonl")
+    manifest = Manifest(Path(args.manifest or f"{output}.manifest.json"))
+
+    writer = ParquetWriter(output) if output_format == "parquet" else JsonlWriter(output)
+
+    # Record scritti prima di un'interruzione ma non ancora nel manifest:
+    # li consideriamo completati per non duplicarli
+    files = find_audio_files(args.inputs)
+    in_output = writer.existing_paths()
+    recovered = [p for p in files if str(p) in in_output and str(p) not in manifest.entries]
+    for path in recovered:
+        manifest.mark(path, "done")
+    if recovered:
+        logger.info(f"{len(recovered)} file già presenti nell'output segnati come completati")
+        manifest.save()
+
+    pending = [p for p in files if not manifest.is_done(p)]
+    # File modificati dall'ultima esecuzione: il vecchio testo lascia il posto al nuovo
+    stale = {str(p) for p in pending if str(p) in in_output}
+    if stale:
+        logger.info(f"{len(stale)} file modificati dall'ultima esecuzione: rimuovo i vecchi record")
+        writer.discard(stale)
+    skipped = len(files) - len(pending)
+    logger.info(f"Trovati {len(files)} file audio, {skipped} già trascritti, {len(pending)} da elaborare")
+    if not pending:
+        writer.close()
+        return
+    unflushed: List[Dict] = []
+    done = errors = 0
+    audio_seconds = 0.0
+    start_time = time.time()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.workers, initializer=init_worker, initargs=(args.chunk_concurrency,)
+        ) as executor:
+            futures = {executor.submit(transcribe_file, str(p)): p for p in pending}
+            for future in concurrent.futures.as_completed(futures):
+                path = futures[future]
+                record = future.result()
+                if record["error"]:
+                    errors += 1
+                    manifest.mark(path, "error", record["error"])
+                    manifest.save()
+                else:
+                    done += 1
+                    audio_seconds += record["duration_s"] or 0
+                    unflushed.append(record)
+                    # Il manifest segna "done" solo ciò che è già su disco
+                    if writer.write(record):
+                        for flushed in unflushed:
+                            manifest.mark(Path(flushed["path"]), "done")
+                        unflushed = []
+                        manifest.save()
+                elapsed = time.time() - start_time
+                outcome = "ERRORE" if record["error"] else f"{record['duration_s'] or 0:.0f}s di audio"
+                logger.info(
+                    f"[{done + errors}/{len(pending)}] {path.name}: {outcome} in {record['elapsed_s']:.1f}s, "
+                    f"velocità {audio_seconds / elapsed:.1f}x tempo reale"
+                )
+    finally:
+        writer.close()
+        for flushed in unflushed:
+            manifest.mark(Path(flushed["path"]), "done")
+        manifest.save()
+
+    elapsed = time.time() - start_time
+    print(
+        f"Completati {done} file, {errors} errori, {skipped} saltati (già trascritti)\n"
+        f"Audio trascritto: {audio_seconds / 3600:.2f} ore in {elapsed / 60:.1f} minuti\n"
+        f"Throughput: {done / elapsed * 60:.1f} file/min, {audio_seconds / elapsed:.1f}x tempo reale"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,6 @@ import tempfile
 import asyncio
 from telegram import Update
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
-import concurrent.futures
 from dotenv import load_dotenv
 from logging_config import setup_logger
 
@@ -20,10 +19,25 @@ from helpers import (
     transcribe_audio_chunks_async,
     split_text_for_telegram,
     convert_audio_to_wav,
-    summarize_transcription
+    summarize_transcription,
+    SUMMARY_MIN_CHARS
 )
 
 
+def get_declared_duration(media) -> float:
+    """
+    Restituisce in secondi la durata dichiarata da Telegram per voice/audio,
+    o None se non disponibile.
+    """
+    duration = getattr(media, "duration", None)
+    if duration is None:
+        return None
+    # Le versioni recenti di python-telegram-bot restituiscono un timedelta
+    if hasattr(duration, "total_seconds"):
+        return duration.total_seconds()
+    return float(duration)
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Inviami un messaggio vocale e ti invierò la trascrizione!")
 
@@ -35,13 +49,17 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     3. Invia il risultato in uno o più messaggi
     """
     if update.message.voice:
-        file = await context.bot.get_file(update.message.voice.file_id)
+        media = update.message.voice
     elif update.message.audio:
-        file = await context.bot.get_file(update.message.audio.file_id)
+        media = update.message.audio
     else:
         await update.message.reply_text("Invia un messaggio vocale o un audio validi.")
         return
 
+    # Durata dichiarata da Telegram, nota prima del download: serve allo scheduler
+    declared_duration = get_declared_duration(media)
+    file = await context.bot.get_file(media.file_id)
+
     # Invio messaggio di elaborazione in corso
     processing_message = await update.message.reply_text("⏱️ Sto elaborando il tuo messaggio vocale...")
     
@@ -51,11 +69,15 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await file.download_to_drive(temp_audio.name)
             
             # Converti in WAV con la funzione generica
-            wav_path = convert_audio_to_wav(temp_audio.name)
+            wav_path = await asyncio.to_thread(convert_audio_to_wav, temp_audio.name)
             
             # Elabora l'audio (trascrive o riassume in base alla lunghezza)
             # result_text = transcribe_audio_chunks(wav_path)
-            result_text = await transcribe_audio_chunks_async(wav_path)
+            # Alcuni motori (Gemini) restituiscono il riassunto insieme alla trascrizione
+            result = await transcribe_audio_chunks_async(
+                wav_path, declared_duration=declared_duration, with_summaries=True
+            )
+            result_text, engine_summaries = result.text, result.summaries
             
             # Elimina i file temporanei
             try:
@@ -85,11 +107,17 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
             for part in text_parts[1:]:
                 await update.message.reply_text(part)
             
-            # Invia riassunti se il primo messaggio è più lungo di 2000 caratteri
-            if len(text_parts[0]) > 2000:
+            # Invia riassunti se il primo messaggio è più lungo di SUMMARY_MIN_CHARS caratteri
+            if len(text_parts[0]) > SUMMARY_MIN_CHARS:
                 await update.message.reply_text("Le trascrizioni sono lunghe, invio i riassunti...")
-                with concurrent.futures.ThreadPoolExecutor() as executor:
-                    chunk_summaries = list(executor.map(summarize_transcription, text_parts))
+                if engine_summaries:
+                    # Riassunti già pronti: nessuna chiamata aggiuntiva all'LLM
+                    chunk_summaries = split_text_for_telegram("\n\n".join(engine_summaries))
+                else:
+                    # In thread separati: il loop deve restare libero per le altre richieste
+                    chunk_summaries = await asyncio.gather(
+                        *(asyncio.to_thread(summarize_transcription, part) for part in text_parts)
+                    )
                 for i, summary in enumerate(chunk_summaries):
                     if summary:
                         await update.message.reply_text(f"Riassunto {i+1}:\n{summary}")
@@ -106,7 +134,18 @@ TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 if not TOKEN:
     raise Exception("Errore: Token Telegram non trovato. Impostalo nel file .env come TELEGRAM_BOT_TOKEN.")
     
-bot_app = ApplicationBuilder().token(TOKEN).build()
+# Endpoint alternativi della Bot API (es. server locale o finto per i load test)
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL")
+TELEGRAM_API_BASE_FILE_URL = os.getenv("TELEGRAM_API_BASE_FILE_URL")
+
+# Gli update vengono gestiti in parallelo: è lo scheduler delle trascrizioni a
+# decidere l'ordine in cui i chunk occupano il riconoscitore
+builder = ApplicationBuilder().token(TOKEN).concurrent_updates(True)
+if TELEGRAM_API_BASE_URL:
+    builder = builder.base_url(TELEGRAM_API_BASE_URL)
+if TELEGRAM_API_BASE_FILE_URL:
+    builder = builder.base_file_url(TELEGRAM_API_BASE_FILE_URL)
+bot_app = builder.build()
 
 bot_app.add_handler(CommandHandler("start", start))
 bot_app.add_handler(MessageHandler(filters.VOICE, handle_voice))
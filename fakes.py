@@ -0,0 +1,120 @@
+"""
+Componenti finti per test e benchmark locali, senza chiamare servizi esterni.
+"""
+
+import os
+import random
+import threading
+import time
+from typing import Any, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import RunnableLambda
+
+from logging_config import setup_logger
+
+# Configurazione del logger
+logger = setup_logger(__name__)
+
+
+class FakeEngineError(RuntimeError):
+    """Errore iniettato dal motore finto."""
+
+
+class FakeEngine:
+    """
+    Motore di trascrizione finto con latenza ed errori iniettabili.
+
+    Args:
+        latency_s: Latenza media di ogni chiamata
+        jitter_s: Variazione massima (uniforme) attorno alla latenza media
+        error_rate: Probabilità che una chiamata sollevi FakeEngineError
+        hang_rate: Probabilità che una chiamata resti bloccata per hang_s secondi
+        hang_s: Durata di un blocco
+        text: Testo restituito per ogni chunk
+        seed: Seed del generatore casuale, per esperimenti ripetibili
+    """
+
+    def __init__(
+        self,
+        latency_s: float = 0.5,
+        jitter_s: float = 0.0,
+        error_rate: float = 0.0,
+        hang_rate: float = 0.0,
+        hang_s: float = 300.0,
+        text: str = "Trascrizione di prova.",
+        seed: Optional[int] = None,
+    ):
+        self.latency_s = latency_s
+        self.jitter_s = jitter_s
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang_s = hang_s
+        self.text = text
+        self.calls = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, prefix: str = "FAKE_ENGINE_") -> "FakeEngine":
+        """Crea un motore finto leggendo i parametri da variabili d'ambiente."""
+        seed = os.getenv(f"{prefix}SEED")
+        return cls(
+            latency_s=float(os.getenv(f"{prefix}LATENCY_S", "0.5")),
+            jitter_s=float(os.getenv(f"{prefix}JITTER_S", "0")),
+            error_rate=float(os.getenv(f"{prefix}ERROR_RATE", "0")),
+            hang_rate=float(os.getenv(f"{prefix}HANG_RATE", "0")),
+            hang_s=float(os.getenv(f"{prefix}HANG_S", "300")),
+            text=os.getenv(f"{prefix}TEXT", "Trascrizione di prova."),
+            seed=int(seed) if seed is not None else None,
+        )
+
+    def __call__(self, file_path: str) -> str:
+        with self._lock:
+            self.calls += 1
+            latency = max(0.0, self.latency_s + self._random.uniform(-self.jitter_s, self.jitter_s))
+            hang = self._random.random() < self.hang_rate
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.failures += 1
+        logger.debug(f"Motore finto su {file_path}: latenza {latency:.2f}s, blocco={hang}, errore={fail}")
+        time.sleep(self.hang_s if hang else latency)
+        if fail:
+            raise FakeEngineError(f"Errore iniettato dal motore finto su {file_path}")
+        return self.text
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model finto con latenza fissa, al posto di Gemini nei benchmark locali.
+
+    Risponde sempre con ``text``; con with_structured_output() restituisce lo
+    schema richiesto con tutti i campi valorizzati a ``text``.
+    """
+
+    latency_s: float = 1.0
+    text: str = "Trascrizione di prova."
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        time.sleep(self.latency_s)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.text))])
+
+    def with_structured_output(self, schema, **kwargs):
+        def respond(_input):
+            time.sleep(self.latency_s)
+            return schema(**{name: self.text for name in schema.model_fields})
+
+        return RunnableLambda(respond)
@@ -5,16 +5,27 @@ from pydub import AudioSegment
 import azure.cognitiveservices.speech as speechsdk
 from langchain.prompts import PromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI
-from prompts import SYSTEM_PROMPT, SUMMARY_PROMPT, PUNCTUATED_PROMPT
+from prompts import SYSTEM_PROMPT, SUMMARY_PROMPT, PUNCTUATED_PROMPT, GEMINI_TRANSCRIPTION_PROMPT, GEMINI_SUMMARY_DIRECTIVE
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.messages import HumanMessage
+from pydantic import BaseModel, Field
+import base64
 from datetime import datetime, timedelta
 import asyncio
+import subprocess
 import time
 import wave
 import contextlib
 import concurrent.futures
-from typing import List, Tuple, Dict
+from typing import Callable, List, NamedTuple, Tuple, Dict, Optional
 from logging_config import setup_logger
+from scheduler import SCHEDULER
+from resilience import ResilientEngine, CHUNK_DEADLINE_S, CHUNK_MAX_RETRIES, RETRY_BACKOFF_BASE_S, HEDGE_PERCENTILE
+from autotune import (
+    AUTOTUNER, TuningPlan, chunking_plan,
+    CHUNK_DURATION_MS, OVERLAP_DURATION_MS, GROUP_SIZE, GROUP_PAUSE_S,
+)
+from fakes import FakeEngine, FakeChatModel
 import speech_recognition as sr
 
 # Configurazione del logger
@@ -23,14 +34,19 @@ logger = setup_logger(__name__)
 # Config Gemini (qui usiamo ChatOpenAI come placeholder)
 GEMINI_API_KEY = os.getenv("GOOGLE_API_KEY")
 
-llm = ChatGoogleGenerativeAI(
-    model=os.getenv("GOOGLE_GEMINI_MODEL", "gemini-2.0-flash"),
-    temperature=0,
-    max_tokens=20000,
-    timeout=None,
-    max_retries=5,
-    # other params...
-)
+# LLM_BACKEND=fake sostituisce Gemini con un modello locale per i benchmark
+if os.getenv("LLM_BACKEND") == "fake":
+    llm = FakeChatModel(latency_s=float(os.getenv("FAKE_LLM_LATENCY_S", "1")))
+else:
+    llm = ChatGoogleGenerativeAI(
+        model=os.getenv("GOOGLE_GEMINI_MODEL", "gemini-2.0-flash"),
+        temperature=0,
+        max_tokens=20000,
+        # Timeout reale: i thread abbandonati dal livello resiliente devono terminare
+        timeout=CHUNK_DEADLINE_S,
+        max_retries=2,
+        # other params...
+    )
 
 summary_prompt = PromptTemplate.from_template(
     SUMMARY_PROMPT
@@ -40,18 +56,49 @@ PUNCTUATION_CHAIN = PromptTemplate.from_template(
     PUNCTUATED_PROMPT
 ) | llm | StrOutputParser()
 
+
+class GeminiTranscription(BaseModel):
+    """Risposta strutturata del motore Gemini per un chunk audio."""
+    transcription: str = Field(description="Punctuated Italian transcription of the audio")
+    summary: Optional[str] = Field(default=None, description="Italian summary of the transcription")
+
+
+GEMINI_TRANSCRIPTION_CHAIN = llm.with_structured_output(GeminiTranscription)
+# Chiede a Gemini anche il riassunto nella stessa risposta
+GEMINI_INCLUDE_SUMMARY = os.getenv("GEMINI_INCLUDE_SUMMARY", "false").lower() in ("1", "true", "yes")
+# Il bot invia i riassunti solo per trascrizioni più lunghe di SUMMARY_MIN_CHARS;
+# sotto SUMMARY_MIN_DURATION_S di audio (circa quella lunghezza) non li chiediamo al motore
+SUMMARY_MIN_CHARS = 2000
+SUMMARY_MIN_DURATION_S = float(os.getenv("SUMMARY_MIN_DURATION_S", "120"))
+
 # Config Azure Speech
 AZURE_SPEECH_KEY = os.getenv("AZURE_SPEECH_KEY")
 AZURE_SPEECH_REGION = os.getenv("AZURE_SPEECH_REGION")
 
-TRANSCRIPTION_ENGINE = os.getenv("TRANSCRIPTION_ENGINE", "google-legacy")  # "azure" or "google"
+TRANSCRIPTION_ENGINE = os.getenv("TRANSCRIPTION_ENGINE", "google-legacy")  # "google-legacy", "gemini", "azure" o "fake"
+# Motore usato quando il circuit breaker del principale è aperto (opzionale)
+TRANSCRIPTION_FALLBACK_ENGINE = os.getenv("TRANSCRIPTION_FALLBACK_ENGINE")
 
 # Costanti per la gestione dell'audio
-CHUNK_DURATION_MS = 60 * 1000
-OVERLAP_DURATION_MS = 3 * 1000
+# CHUNK_DURATION_MS, OVERLAP_DURATION_MS, GROUP_SIZE e GROUP_PAUSE_S sono in
+# autotune.py: con AUTOTUNE attivo sono solo i valori di partenza
 MAX_TELEGRAM_MESSAGE_LENGTH = 4000  # Massimo caratteri per messaggio Telegram
+# Segnaposto per i chunk che non è stato possibile trascrivere
+FAILED_CHUNK_MARKER = "[⚠️ parte {index} non trascritta]"
 LONG_AUDIO_THRESHOLD_MS = 90 * 1000
 
+# Formati di upload dei chunk: ogni chunk viene codificato una sola volta,
+# direttamente nel formato che il motore invia al servizio remoto
+UPLOAD_SAMPLE_RATE = 16000
+UPLOAD_FORMATS = {
+    "wav": {"format": "wav", "suffix": ".wav", "mime_type": "audio/wav"},
+    "flac": {"format": "flac", "suffix": ".flac", "mime_type": "audio/flac"},
+    "opus": {"format": "ogg", "codec": "libopus", "bitrate": "32k", "suffix": ".ogg", "mime_type": "audio/ogg"},
+}
+
+# Chiave per l'API Web Speech di Google (default: quella di SpeechRecognition)
+GOOGLE_SPEECH_API_KEY = os.getenv("GOOGLE_SPEECH_API_KEY")
+
 
 def get_wav_duration(file_path: str) -> float:
     logger.debug(f"Ottenimento della durata del file WAV: {file_path}")
@@ -88,21 +135,48 @@ def convert_audio_to_wav(input_path: str) -> str:
         str: Path to the converted WAV file.
     """
     output_path = tempfile.NamedTemporaryFile(suffix=".wav", delete=False).name
-    command = f"ffmpeg -i {input_path} -ar 16000 -ac 1 {output_path} -y"
-    os.system(command)
+    # Lista di argomenti: i percorsi con spazi o caratteri speciali restano intatti
+    command = ["ffmpeg", "-nostdin", "-i", str(input_path), "-ar", "16000", "-ac", "1", output_path, "-y"]
+    # Senza stdin: più ffmpeg in parallelo non leggono dal terminale (SIGTTIN in background)
+    result = subprocess.run(command, capture_output=True, stdin=subprocess.DEVNULL)
+    if result.returncode != 0:
+        logger.error(f"Errore ffmpeg durante la conversione di {input_path}: {result.stderr.decode(errors='ignore')[-500:]}")
+        raise RuntimeError(f"Errore durante la conversione in wav di {input_path}")
     return output_path
 
 
-def split_audio_file(audio_path: str) -> List[str]:
+def get_chunk_spans(total_ms: int, chunk_ms: int = CHUNK_DURATION_MS, overlap_ms: int = OVERLAP_DURATION_MS) -> List[Tuple[int, int]]:
+    """Intervalli (inizio, fine) in millisecondi dei chunk con sovrapposizione."""
+    spans = []
+    for start_ms in range(0, total_ms, chunk_ms - overlap_ms):
+        end_ms = min(start_ms + chunk_ms, total_ms)
+        spans.append((start_ms, end_ms))
+        if end_ms >= total_ms:
+            break
+    return spans or [(0, total_ms)]
+
+
+def split_audio_file(
+    audio_path: str,
+    upload_format: str = "wav",
+    chunk_ms: int = CHUNK_DURATION_MS,
+    overlap_ms: int = OVERLAP_DURATION_MS,
+) -> List[str]:
     """
-    Divide un file audio in chunk con sovrapposizione.
+    Divide un file audio in chunk con sovrapposizione, codificati a 16 kHz mono
+    nel formato di upload del motore.
     
     Args:
         audio_path: Percorso del file audio da dividere
+        upload_format: Chiave di UPLOAD_FORMATS in cui esportare i chunk
+        chunk_ms: Durata di ogni chunk in millisecondi
+        overlap_ms: Sovrapposizione tra chunk consecutivi in millisecondi
         
     Returns:
-        Lista di percorsi ai file audio temporanei
+        Lista di percorsi ai file audio temporanei (o [audio_path] se l'audio
+        è già un unico chunk WAV)
     """
+    export_options = UPLOAD_FORMATS[upload_format]
     try:
         logger.info(f"Dividendo il file audio in chunk: {audio_path}")
         # Carica l'audio
@@ -114,15 +188,15 @@ def split_audio_file(audio_path: str) -> List[str]:
         
         chunk_files = []
         
-        # Se l'audio è più corto della dimensione di un chunk, lo restituiamo così com'è
-        if total_duration <= CHUNK_DURATION_MS:
+        # Se l'audio è più corto della dimensione di un chunk non lo dividiamo:
+        # se è già nel formato di upload lo restituiamo così com'è
+        if total_duration <= chunk_ms and upload_format == "wav":
             logger.info("Audio più corto della dimensione di un chunk, non diviso")
             return [audio_path]
+        audio = audio.set_frame_rate(UPLOAD_SAMPLE_RATE).set_channels(1)
         
         # Altrimenti lo dividiamo in chunk con sovrapposizione
-        for start_ms in range(0, total_duration, CHUNK_DURATION_MS - OVERLAP_DURATION_MS):
-            # Calcola l'inizio e la fine del chunk
-            end_ms = min(start_ms + CHUNK_DURATION_MS, total_duration)
+        for start_ms, end_ms in get_chunk_spans(total_duration, chunk_ms, overlap_ms):
             chunk_duration = (end_ms - start_ms) / 1000
             
             logger.info(f"Creazione chunk {len(chunk_files)+1}: {start_ms/1000:.1f}s - {end_ms/1000:.1f}s ({chunk_duration:.1f}s)")
@@ -130,16 +204,18 @@ def split_audio_file(audio_path: str) -> List[str]:
             # Estrai il chunk
             chunk = audio[start_ms:end_ms]
             
-            # Salva il chunk in un file temporaneo
-            temp_chunk = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
-            chunk.export(temp_chunk.name, format="wav")
+            # Salva il chunk in un file temporaneo, già nel formato di upload
+            temp_chunk = tempfile.NamedTemporaryFile(delete=False, suffix=export_options["suffix"])
+            temp_chunk.close()
+            chunk.export(
+                temp_chunk.name,
+                format=export_options["format"],
+                codec=export_options.get("codec"),
+                bitrate=export_options.get("bitrate"),
+            )
             chunk_files.append(temp_chunk.name)
-            
-            # Se siamo arrivati alla fine dell'audio, usciamo dal ciclo
-            if end_ms >= total_duration:
-                break
         
-        logger.info(f"Creati {len(chunk_files)} chunk audio")
+        logger.info(f"Creati {len(chunk_files)} chunk audio in formato {upload_format}")
         return chunk_files
     except Exception as e:
         logger.error(f"Errore durante la divisione dell'audio: {e}", exc_info=True)
@@ -211,17 +287,37 @@ def transcribe_audio_azure(file_path: str) -> str:
     return full_transcription
 ################# DEPRECATA ######################
 
+class FlacAudioData(sr.AudioData):
+    """
+    AudioData per un chunk già codificato in FLAC: recognize_google invia i
+    byte così come sono invece di ricodificarli con un sottoprocesso `flac`.
+    """
+
+    def __init__(self, flac_data: bytes, sample_rate: int = UPLOAD_SAMPLE_RATE):
+        super().__init__(b"", sample_rate, 2)
+        self.flac_data = flac_data
+
+    def get_flac_data(self, convert_rate=None, convert_width=None) -> bytes:
+        return self.flac_data
+
+
 def transcribe_audio_google(file_path: str) -> str:
     logger.info(f"Iniziata trascrizione Google Speech per il file: {file_path}")
     recognizer = sr.Recognizer()
+    # Evita che una richiesta bloccata occupi il thread oltre la deadline del chunk
+    recognizer.operation_timeout = CHUNK_DEADLINE_S
     # Controlla se il file esiste
     if not Path(file_path).is_file():
         logger.error(f"File non trovato: {file_path}")
         raise FileNotFoundError(f"File non trovato: {file_path}")
 
-    with sr.AudioFile(file_path) as source:
-        audio_data = sr.Recognizer().record(source)
-        text = recognizer.recognize_google(audio_data, language="it-IT")
+    if Path(file_path).suffix == ".flac":
+        # Chunk già codificato in FLAC: lo inviamo senza ricodificarlo
+        audio_data = FlacAudioData(Path(file_path).read_bytes())
+    else:
+        with sr.AudioFile(file_path) as source:
+            audio_data = sr.Recognizer().record(source)
+    text = recognizer.recognize_google(audio_data, key=GOOGLE_SPEECH_API_KEY, language="it-IT")
     logger.info(f"Trascrizione completata con Google Speech: {len(text)} caratteri")
     logger.info("Invio a Gemini per punteggiatura")
     # Invia il testo a Gemini per la punteggiatura
@@ -230,16 +326,161 @@ def transcribe_audio_google(file_path: str) -> str:
 
     return punctuated_text
 
+class ChunkResult(NamedTuple):
+    """Testo di un chunk con l'eventuale riassunto prodotto nella stessa chiamata."""
+    text: str
+    summary: Optional[str] = None
+
+
+class TranscriptionResult(NamedTuple):
+    """Trascrizione di un file con i riassunti restituiti dal motore, in ordine."""
+    text: str
+    summaries: List[str]
+
+
+def transcribe_audio_gemini(file_path: str, with_summary: bool = False) -> ChunkResult:
+    """
+    Trascrive un chunk con una sola chiamata multimodale a Gemini, che
+    restituisce il testo già punteggiato (e, con with_summary, il riassunto).
+    """
+    logger.info(f"Iniziata trascrizione Gemini per il file: {file_path}")
+    file_path = Path(file_path)
+    if not file_path.is_file():
+        logger.error(f"File non trovato: {file_path}")
+        raise FileNotFoundError(f"File non trovato: {file_path}")
+
+    mime_type = next(
+        (options["mime_type"] for options in UPLOAD_FORMATS.values() if options["suffix"] == file_path.suffix),
+        "audio/wav",
+    )
+    prompt = GEMINI_TRANSCRIPTION_PROMPT.format(
+        summary_directive=GEMINI_SUMMARY_DIRECTIVE if with_summary else ""
+    )
+    message = HumanMessage(content=[
+        {"type": "text", "text": prompt},
+        {"type": "media", "mime_type": mime_type, "data": base64.b64encode(file_path.read_bytes()).decode()},
+    ])
+    response = GEMINI_TRANSCRIPTION_CHAIN.invoke([message])
+    logger.info(f"Trascrizione completata con Gemini: {len(response.transcription)} caratteri")
+    return ChunkResult(response.transcription, response.summary if with_summary else None)
+
+
+# Con FAKE_ENGINE_PUNCTUATE il motore finto simula il percorso a due chiamate
+# (riconoscimento + punteggiatura con PUNCTUATION_CHAIN)
+FAKE_ENGINE = FakeEngine.from_env()
+FAKE_ENGINE_PUNCTUATE = os.getenv("FAKE_ENGINE_PUNCTUATE", "false").lower() in ("1", "true", "yes")
+
+
+def transcribe_audio_fake(file_path: str) -> str:
+    text = FAKE_ENGINE(file_path)
+    if FAKE_ENGINE_PUNCTUATE:
+        text = PUNCTUATION_CHAIN.invoke({"transcription": text})
+    return text
+
+
+ENGINES = {
+    "google-legacy": transcribe_audio_google,
+    "azure": transcribe_audio_azure,
+    "gemini": transcribe_audio_gemini,
+    "fake": transcribe_audio_fake,
+}
+
+
+# Formato di upload nativo di ciascun motore
+ENGINE_UPLOAD_FORMATS = {
+    "google-legacy": "flac",
+    "azure": "wav",
+    "gemini": "opus",
+    "fake": "wav",
+}
+
+
+def get_upload_format() -> str:
+    """
+    Formato in cui codificare i chunk per il motore configurato.
+    Se il motore di fallback preferisce un altro formato si usa WAV, che
+    tutti i motori accettano.
+    """
+    upload_format = ENGINE_UPLOAD_FORMATS.get(TRANSCRIPTION_ENGINE, "wav")
+    if TRANSCRIPTION_FALLBACK_ENGINE and ENGINE_UPLOAD_FORMATS.get(TRANSCRIPTION_FALLBACK_ENGINE, "wav") != upload_format:
+        return "wav"
+    return upload_format
+
+
+# Motori che restituiscono già un ChunkResult e accettano with_summary
+SUMMARY_ENGINES = {"gemini"}
+
+
+def get_engine(name: str):
+    """Restituisce la funzione di trascrizione del motore indicato (default: Azure)."""
+    return ENGINES.get(name, transcribe_audio_azure)
+
+
+def get_chunk_engine(name: str) -> Callable[..., ChunkResult]:
+    """
+    Motore indicato con un'interfaccia uniforme: ``engine(file_path, with_summary=False)``
+    restituisce sempre un ChunkResult. I motori che non producono riassunti
+    ignorano with_summary.
+    """
+    engine = get_engine(name)
+
+    def transcribe(file_path: str, with_summary: bool = False) -> ChunkResult:
+        if name in SUMMARY_ENGINES:
+            return engine(file_path, with_summary=with_summary)
+        return ChunkResult(engine(file_path))
+
+    return transcribe
+
+
+# Livello resiliente usato dal percorso asincrono: deadline, retry, hedging e fallback
+# Executor dedicato ai motori. Un tentativo scaduto tiene occupato il suo thread
+# finché il motore non risponde (riconoscimento più punteggiatura con i suoi
+# retry), quindi oltre agli slot dello scheduler (il doppio con l'hedging) c'è
+# margine per i thread abbandonati da ogni retry: i nuovi tentativi partono
+# subito invece di attendere in coda, dove salterebbero la priorità dello scheduler.
+# I thread vengono creati solo quando servono.
+ENGINE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=SCHEDULER.max_concurrency * (2 if HEDGE_PERCENTILE else 1) * (CHUNK_MAX_RETRIES + 1),
+    thread_name_prefix="engine",
+)
+
+TRANSCRIBER = ResilientEngine(
+    TRANSCRIPTION_ENGINE,
+    get_chunk_engine(TRANSCRIPTION_ENGINE),
+    fallback_name=TRANSCRIPTION_FALLBACK_ENGINE,
+    fallback=get_chunk_engine(TRANSCRIPTION_FALLBACK_ENGINE) if TRANSCRIPTION_FALLBACK_ENGINE else None,
+    # Audio senza parlato riconoscibile: ritentare non serve
+    non_retryable=(sr.UnknownValueError, FileNotFoundError),
+    # Ogni tentativo alimenta l'autotuner di lunghezza dei chunk e concorrenza
+    observer=AUTOTUNER.record,
+    executor=ENGINE_EXECUTOR,
+)
+
+
+def get_chunking_plan(duration_s: float) -> TuningPlan:
+    """
+    Piano di chunking per un audio con il motore configurato (vedi autotune.chunking_plan).
+    I job divisi in chunk usano la corsia normale dello scheduler, quindi non
+    possono avere più chunk in parallelo dei suoi slot.
+    """
+    plan = chunking_plan(
+        TRANSCRIPTION_ENGINE, duration_s, TRANSCRIPTION_FALLBACK_ENGINE,
+        max_concurrency=SCHEDULER.normal_lane_slots, backoff_s=RETRY_BACKOFF_BASE_S,
+    )
+    logger.info(
+        f"Piano dell'autotuner: chunk da {plan.chunk_s:.0f}s, {plan.concurrency} in parallelo, "
+        f"tempo atteso {plan.expected_wall_s:.1f}s"
+    )
+    return plan
+
+
 def transcribe_chunk(chunk_path: str) -> str:
     """
     Funzione per trascrivere un singolo chunk audio.
     Da usare con ThreadPoolExecutor.
     """
     logger.debug(f"Iniziata trascrizione del chunk: {chunk_path}")
-    if TRANSCRIPTION_ENGINE == "google-legacy":
-        result = transcribe_audio_google(chunk_path)
-    else:
-        result = transcribe_audio_azure(chunk_path)
+    result = get_chunk_engine(TRANSCRIPTION_ENGINE)(chunk_path).text
     logger.debug(f"Terminata trascrizione del chunk: {chunk_path}")
     return result
 
@@ -268,15 +509,14 @@ def transcribe_audio_chunks(audio_path: str) -> str:
     # Dividi l'audio in chunk solo se è più lungo della soglia
     if duration_ms > CHUNK_DURATION_MS:
         logger.info("Audio più lungo della soglia di chunking, dividendo in parti...")
-        chunks = split_audio_file(audio_path)
     else:
         logger.info("Audio più corto della soglia di chunking, elaborando come singolo file")
-        chunks = [audio_path]
+    chunks = split_audio_file(audio_path, get_upload_format())
         
     # Trascrivi tutti i chunk in gruppi di massimo 8
-    logger.info(f"Inizio trascrizione di {len(chunks)} chunk audio in gruppi di massimo 8")
+    logger.info(f"Inizio trascrizione di {len(chunks)} chunk audio in gruppi di massimo {GROUP_SIZE}")
     transcriptions = []
-    group_size = 8
+    group_size = GROUP_SIZE
     n_groups, remainder = divmod(len(chunks), group_size)
     if remainder > 0:
         n_groups += 1
@@ -287,8 +527,8 @@ def transcribe_audio_chunks(audio_path: str) -> str:
             transcriptions.extend(executor.map(transcribe_chunk, group))
         logger.info(f"Gruppo {i + 1} completato")
         if i != (n_groups - 1):
-            logger.info(f"Attesa di 15 secondi prima di elaborare il prossimo gruppo...")
-            time.sleep(15)
+            logger.info(f"Attesa di {GROUP_PAUSE_S} secondi prima di elaborare il prossimo gruppo...")
+            time.sleep(GROUP_PAUSE_S)
     logger.info("Trascrizione di tutti i gruppi completata")
       
     # Unisci le trascrizioni senza riassumere
@@ -296,7 +536,7 @@ def transcribe_audio_chunks(audio_path: str) -> str:
     logger.info(f"Trascrizione completata: {len(result)} caratteri")
         
     # Pulisci i file temporanei (tranne l'originale)
-    if len(chunks) > 1:
+    if chunks != [audio_path]:
         logger.info("Pulizia dei file temporanei...")
         for chunk in chunks:
             try:
@@ -373,15 +613,39 @@ def split_text_for_telegram(text: str) -> List[str]:
     logger.info(f"Testo diviso in {len(parts)} parti per Telegram")
     return parts
 
-async def transcribe_audio_chunks_async(audio_path: str) -> str:
+async def transcribe_chunk_scheduled(
+    chunk_path: str, declared_duration: float, chunk_s: float = None, with_summary: bool = False
+) -> ChunkResult:
+    """
+    Trascrive un chunk dopo aver ottenuto uno slot dallo SCHEDULER.
+    Lo slot viene rilasciato a fine chunk, così i job lunghi cedono il passo
+    alle note brevi ai confini dei chunk.
+    """
+    async with SCHEDULER.slot(declared_duration):
+        logger.debug(f"Iniziata trascrizione del chunk: {chunk_path}")
+        result = await TRANSCRIBER.call(chunk_path, duration_s=chunk_s, with_summary=with_summary)
+        logger.debug(f"Terminata trascrizione del chunk: {chunk_path}")
+        return result
+
+
+async def transcribe_audio_chunks_async(
+    audio_path: str, declared_duration: float = None, with_summaries: bool = False
+) -> TranscriptionResult:
     """
     Async: Trascrive un file audio dividendolo in chunk e processandoli in parallelo.
 
+    Ogni chunk attende uno slot dello SCHEDULER condiviso, che dà priorità ai
+    job più brevi in base alla durata dichiarata.
+
     Args:
         audio_path: Percorso del file audio da trascrivere
+        declared_duration: Durata in secondi dichiarata da Telegram; se assente
+            si usa quella misurata sul file
+        with_summaries: Chiede al motore (es. Gemini con GEMINI_INCLUDE_SUMMARY)
+            anche il riassunto di ogni chunk, se l'audio supera SUMMARY_MIN_DURATION_S
 
     Returns:
-        str: Testo trascritto o riassunto
+        TranscriptionResult: Testo trascritto e riassunti restituiti dal motore
     """
     logger.info(f"Inizio elaborazione audio: {audio_path}")
 
@@ -394,18 +658,28 @@ async def transcribe_audio_chunks_async(audio_path: str) -> str:
     duration_ms = await asyncio.to_thread(get_wav_duration, audio_path)
     duration_ms *= 1000
     logger.info(f"Durata audio: {duration_ms/1000:.2f} secondi")
-
-    # Chunking
-    if duration_ms > CHUNK_DURATION_MS:
+    if declared_duration is None:
+        declared_duration = duration_ms / 1000
+    with_summary = with_summaries and GEMINI_INCLUDE_SUMMARY and duration_ms / 1000 >= SUMMARY_MIN_DURATION_S
+
+    # Chunking secondo il piano dell'autotuner
+    # Fuori dal loop: la stima del modello scorre tutte le osservazioni
+    plan = await asyncio.to_thread(get_chunking_plan, duration_ms / 1000)
+    chunk_ms = int(plan.chunk_s * 1000)
+    if duration_ms > chunk_ms:
         logger.info("Audio più lungo della soglia di chunking, dividendo in parti...")
-        chunks = await asyncio.to_thread(split_audio_file, audio_path)
     else:
         logger.info("Audio più corto della soglia di chunking, elaborando come singolo file")
-        chunks = [audio_path]
+    chunks = await asyncio.to_thread(split_audio_file, audio_path, get_upload_format(), chunk_ms, OVERLAP_DURATION_MS)
+    chunk_seconds = [(end - start) / 1000 for start, end in get_chunk_spans(int(duration_ms), chunk_ms, OVERLAP_DURATION_MS)]
+    if len(chunk_seconds) != len(chunks):
+        chunk_seconds = [None] * len(chunks)
 
-    logger.info(f"Inizio trascrizione di {len(chunks)} chunk audio in gruppi di massimo 8")
+    logger.info(f"Inizio trascrizione di {len(chunks)} chunk audio in gruppi di massimo {plan.concurrency}")
     transcriptions = []
-    group_size = 8
+    summaries = []
+    failures = []
+    group_size = plan.concurrency
     n_groups, remainder = divmod(len(chunks), group_size)
     if remainder > 0:
         n_groups += 1
@@ -414,22 +688,37 @@ async def transcribe_audio_chunks_async(audio_path: str) -> str:
         group = chunks[i * group_size : (i + 1) * group_size]
         logger.info(f"Elaborazione del gruppo {i + 1} contenente {len(group)} chunk")
 
-        # Esegui la trascrizione dei chunk in parallelo
-        tasks = [asyncio.to_thread(transcribe_chunk, chunk) for chunk in group]
-        results = await asyncio.gather(*tasks)
-        transcriptions.extend(results)
+        # Esegui la trascrizione dei chunk in parallelo, uno slot dello scheduler per chunk
+        group_seconds = chunk_seconds[i * group_size : (i + 1) * group_size]
+        tasks = [
+            transcribe_chunk_scheduled(chunk, declared_duration, chunk_s, with_summary)
+            for chunk, chunk_s in zip(group, group_seconds)
+        ]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        # Un chunk fallito non fa perdere il resto: lo segnaliamo nel testo
+        for index, result in enumerate(results, start=i * group_size + 1):
+            if isinstance(result, BaseException):
+                logger.warning(f"Trascrizione del chunk {index} fallita: {result}")
+                failures.append(result)
+                transcriptions.append(FAILED_CHUNK_MARKER.format(index=index))
+            else:
+                transcriptions.append(result.text)
+                if result.summary:
+                    summaries.append(result.summary)
 
         logger.info(f"Gruppo {i + 1} completato")
         if i != (n_groups - 1):
-            logger.info("Attesa di 15 secondi prima di elaborare il prossimo gruppo...")
-            await asyncio.sleep(15)
+            logger.info(f"Attesa di {GROUP_PAUSE_S} secondi prima di elaborare il prossimo gruppo...")
+            await asyncio.sleep(GROUP_PAUSE_S)
 
     logger.info("Trascrizione di tutti i gruppi completata")
+    # Le osservazioni raccolte sopravvivono ai riavvii
+    await asyncio.to_thread(AUTOTUNER.save)
     result = " ".join(transcriptions)
     logger.info(f"Trascrizione completata: {len(result)} caratteri")
 
     # Pulizia dei file temporanei
-    if len(chunks) > 1:
+    if chunks != [audio_path]:
         logger.info("Pulizia dei file temporanei...")
         for chunk in chunks:
             try:
@@ -437,4 +726,9 @@ async def transcribe_audio_chunks_async(audio_path: str) -> str:
             except Exception as e:
                 logger.warning(f"Impossibile eliminare il file temporaneo {chunk}: {e}")
 
-    return result
\ No newline at end of file
+    if failures and len(failures) == len(chunks):
+        raise RuntimeError(f"Trascrizione fallita per tutti i chunk: {failures[-1]}") from failures[-1]
+    if failures:
+        logger.warning(f"Trascrizione parziale: {len(failures)} chunk su {len(chunks)} non trascritti")
+
+    return TranscriptionResult(result, summaries)
\ No newline at end of file
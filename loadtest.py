@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+"""
+Load test end-to-end del bot con un server finto della Bot API di Telegram.
+
+Il comando ``run`` avvia un server HTTP locale che imita la Bot API (getMe,
+getFile, download dei file, sendMessage, editMessageText), avvia il vero
+``bot_app`` puntandolo a quel server e gli inietta update vocali sintetici
+a un ritmo configurabile. La latenza end-to-end di ogni update va dall'invio
+dell'update al primo editMessageText sulla sua chat (la trascrizione o
+l'errore).
+
+Il comando ``sweep`` ripete ``run`` in sottoprocessi per diversi ritmi e
+configurazioni (variabili d'ambiente di pool e scheduler) e riporta il punto
+di saturazione di ciascuna.
+
+Esempi:
+    python loadtest.py run --rate 2 --duration 60 --mix 5:0.7,40:0.2,600:0.1
+    python loadtest.py sweep --rates 0.5,1,2,4 \\
+        --config SCHEDULER_MAX_CONCURRENCY=4 \\
+        --config SCHEDULER_MAX_CONCURRENCY=8,SCHEDULER_FAST_LANE_SLOTS=2
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from logging_config import setup_logger
+
+# Configurazione del logger
+logger = setup_logger(__name__)
+
+LOADTEST_TOKEN = "123456:loadtest"
+ERROR_PREFIX = "Si è verificato un errore"
+
+# Update di esempio: i campi chat, voice e update_id vengono riscritti per ogni invio
+UPDATE_TEMPLATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": 1, "type": "private", "first_name": "Load"},
+        "from": {"id": 1, "is_bot": False, "first_name": "Load"},
+        "voice": {
+            "file_id": "voice-1",
+            "file_unique_id": "voice-1",
+            "duration": 5,
+            "mime_type": "audio/ogg",
+            "file_size": 0,
+        },
+    },
+}
+
+
+def parse_mix(mix: str) -> List[Tuple[int, float]]:
+    """Interpreta una stringa "durata:peso,..." (durate in secondi)."""
+    entries = []
+    for item in mix.split(","):
+        duration, _, weight = item.partition(":")
+        entries.append((int(duration), float(weight or 1)))
+    return entries
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(math.ceil(p / 100 * len(ordered))) - 1)]
+
+
+def generate_audio(duration_s: int, directory: Path) -> Path:
+    """Genera un WAV mono 16 kHz con un tono, della durata richiesta."""
+    path = directory / f"tone_{duration_s}s.wav"
+    if path.exists():
+        return path
+    rate = 16000
+    period = [int(8000 * math.sin(2 * math.pi * 440 * i / rate)) for i in range(rate)]
+    second = b"".join(v.to_bytes(2, "little", signed=True) for v in period)
+    with wave.open(str(path), "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(rate)
+        for _ in range(duration_s):
+            wf.writeframes(second)
+    return path
+
+
+class FakeBotApiServer:
+    """
+    Server HTTP locale che imita la Bot API di Telegram.
+
+    Serve i file audio registrati con add_file() e memorizza le chiamate a
+    sendMessage/editMessageText con il loro istante di arrivo.
+    """
+
+    def __init__(self, token: str = LOADTEST_TOKEN, host: str = "127.0.0.1", port: int = 0):
+        self.token = token
+        self.files: Dict[str, Path] = {}
+        self.calls: List[Dict] = []
+        self._message_ids = iter(range(1000, 10**9))
+        self._lock = threading.Lock()
+        self._first_edit: Dict[int, Dict] = {}
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-bot-api", daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+        logger.info(f"Server finto della Bot API in ascolto su {self.base_url}")
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def add_file(self, file_id: str, path: Path):
+        self.files[file_id] = path
+
+    def first_edit(self, chat_id: int) -> Optional[Dict]:
+        with self._lock:
+            return self._first_edit.get(chat_id)
+
+    def _record(self, method: str, params: Dict) -> Dict:
+        chat_id = int(params.get("chat_id", 0))
+        call = {"method": method, "chat_id": chat_id, "text": params.get("text", ""), "t": time.monotonic()}
+        with self._lock:
+            self.calls.append(call)
+            if method == "editMessageText":
+                self._first_edit.setdefault(chat_id, call)
+            message_id = int(params.get("message_id") or next(self._message_ids))
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": call["text"],
+        }
+
+    def _handle_method(self, method: str, params: Dict):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "LoadTestBot", "username": "loadtest_bot"}
+        if method == "getFile":
+            file_id = params["file_id"]
+            path = self.files[file_id]
+            return {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_size": path.stat().st_size,
+                "file_path": f"voice/{file_id}{path.suffix}",
+            }
+        if method in ("sendMessage", "editMessageText"):
+            return self._record(method, params)
+        return True
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status: int, body: bytes, content_type: str = "application/json"):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _params(self) -> Dict:
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length).decode() if length else ""
+                params = dict((k, v[-1]) for k, v in parse_qs(urlparse(self.path).query).items())
+                if "json" in (self.headers.get("Content-Type") or ""):
+                    params.update(json.loads(body or "{}"))
+                elif body:
+                    params.update((k, v[-1]) for k, v in parse_qs(body).items())
+                return params
+
+            def _dispatch(self):
+                path = urlparse(self.path).path
+                file_prefix = f"/file/bot{server.token}/"
+                api_prefix = f"/bot{server.token}/"
+                if path.startswith(file_prefix):
+                    file_id = Path(path[len(file_prefix):]).stem
+                    if file_id not in server.files:
+                        return self._send(404, b"not found", "text/plain")
+                    return self._send(200, server.files[file_id].read_bytes(), "application/octet-stream")
+                if not path.startswith(api_prefix):
+                    return self._send(404, json.dumps({"ok": False, "error_code": 404}).encode())
+                method = path[len(api_prefix):]
+                try:
+                    result = server._handle_method(method, self._params())
+                except Exception as e:
+                    body = {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"}
+                    return self._send(400, json.dumps(body).encode())
+                self._send(200, json.dumps({"ok": True, "result": result}).encode())
+
+            do_GET = _dispatch
+            do_POST = _dispatch
+
+        return Handler
+
+
+def build_update(template: Dict, update_id: int, duration_s: int, file_size: int) -> Dict:
+    """Crea un update vocale da template, con chat e file propri."""
+    data = copy.deepcopy(template)
+    message = data["message"]
+    data["update_id"] = update_id
+    message["message_id"] = update_id
+    message["date"] = int(time.time())
+    message["chat"]["id"] = update_id
+    message.setdefault("from", {})["id"] = update_id
+    voice = message.setdefault("voice", {})
+    voice.update(
+        file_id=f"voice-{duration_s}",
+        file_unique_id=f"voice-{update_id}",
+        duration=duration_s,
+        mime_type="audio/wav",
+        file_size=file_size,
+    )
+    return data
+
+
+def summarize(samples: List[Dict], offered_rate: float, started: float) -> Dict:
+    """Calcola throughput e percentili di latenza dai campioni raccolti."""
+    completed = [s for s in samples if s["latency"] is not None]
+    latencies = [s["latency"] for s in completed]
+    elapsed = max((s["sent"] + s["latency"] for s in completed), default=started) - started
+    report = {
+        "offered_rate": offered_rate,
+        "sent": len(samples),
+        "completed": len(completed),
+        "errors": sum(1 for s in completed if s["error"]),
+        "timeouts": len(samples) - len(completed),
+        "throughput": len(completed) / elapsed if elapsed > 0 else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "by_duration": {},
+    }
+    for duration in sorted({s["duration"] for s in samples}):
+        values = [s["latency"] for s in completed if s["duration"] == duration]
+        report["by_duration"][str(duration)] = {
+            "count": len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+        }
+    return report
+
+
+async def run_load(args) -> Dict:
+    """Avvia server finto e bot, invia il carico e raccoglie le latenze."""
+    server = FakeBotApiServer()
+    server.start()
+
+    # Il bot legge la configurazione all'import: la impostiamo prima
+    os.environ["TELEGRAM_BOT_TOKEN"] = LOADTEST_TOKEN
+    os.environ["TELEGRAM_API_BASE_URL"] = f"{server.base_url}/bot"
+    os.environ["TELEGRAM_API_BASE_FILE_URL"] = f"{server.base_url}/file/bot"
+    os.environ.setdefault("TRANSCRIPTION_ENGINE", "fake")
+    os.environ.setdefault("GOOGLE_API_KEY", "loadtest")
+    # Autotuner con stato vuoto e senza esplorazione: esecuzioni ripetibili,
+    # senza leggere né sporcare le osservazioni del bot in produzione
+    os.environ["AUTOTUNE_STATE_PATH"] = str(Path(tempfile.mkdtemp(prefix="audiobot-autotune-")) / "autotune.json")
+    os.environ.setdefault("AUTOTUNE_EXPLORE", "0")
+    from telegram import Update
+    from bot import bot_app
+
+    template = UPDATE_TEMPLATE
+    if args.update_template:
+        template = json.loads(Path(args.update_template).read_text())
+
+    mix = parse_mix(args.mix)
+    audio_dir = Path(args.audio_dir or tempfile.mkdtemp(prefix="audiobot-loadtest-"))
+    audio_dir.mkdir(parents=True, exist_ok=True)
+    for duration, _ in mix:
+        server.add_file(f"voice-{duration}", generate_audio(duration, audio_dir))
+
+    rng = random.Random(args.seed)
+    durations = [d for d, _ in mix]
+    weights = [w for _, w in mix]
+    samples: List[Dict] = []
+
+    await bot_app.initialize()
+    await bot_app.start()
+    started = time.monotonic()
+    try:
+        update_id = 0
+        next_at = started
+        while next_at - started < args.duration:
+            await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+            update_id += 1
+            duration = rng.choices(durations, weights)[0]
+            data = build_update(template, update_id, duration, server.files[f"voice-{duration}"].stat().st_size)
+            samples.append({"chat_id": update_id, "duration": duration, "sent": time.monotonic()})
+            await bot_app.update_queue.put(Update.de_json(data, bot_app.bot))
+            # Arrivi di Poisson al ritmo richiesto
+            next_at += rng.expovariate(args.rate)
+
+        logger.info(f"Inviati {len(samples)} update, attendo il completamento (max {args.drain_timeout}s)")
+        drain_deadline = time.monotonic() + args.drain_timeout
+        while time.monotonic() < drain_deadline:
+            if all(server.first_edit(s["chat_id"]) for s in samples):
+                break
+            await asyncio.sleep(0.2)
+    finally:
+        await bot_app.stop()
+        await bot_app.shutdown()
+        server.stop()
+
+    for sample in samples:
+        edit = server.first_edit(sample["chat_id"])
+        sample["latency"] = edit["t"] - sample["sent"] if edit else None
+        sample["error"] = bool(edit and edit["text"].startswith(ERROR_PREFIX))
+    report = summarize(samples, args.rate, started)
+    report["config"] = {k: v for k, v in os.environ.items() if k.startswith((
+        "SCHEDULER_", "FAST_LANE_", "TRANSCRIPTION_", "FAKE_ENGINE_", "CHUNK_", "HEDGE_", "LLM_", "FAKE_LLM_", "GEMINI_", "AUTOTUNE"
+    ))}
+    return report
+
+
+def format_report(report: Dict) -> str:
+    def fmt(value):
+        return "-" if value is None else f"{value:.2f}s"
+
+    lines = [
+        f"Ritmo offerto: {report['offered_rate']:.2f} update/s, inviati {report['sent']}, "
+        f"completati {report['completed']}, errori {report['errors']}, timeout {report['timeouts']}",
+        f"Throughput: {report['throughput']:.2f} update/s",
+        f"Latenza end-to-end: p50 {fmt(report['p50'])}, p95 {fmt(report['p95'])}, p99 {fmt(report['p99'])}",
+    ]
+    for duration, stats in report["by_duration"].items():
+        lines.append(
+            f"  audio {duration}s ({stats['count']}): p50 {fmt(stats['p50'])}, "
+            f"p95 {fmt(stats['p95'])}, p99 {fmt(stats['p99'])}"
+        )
+    return "\n".join(lines)
+
+
+def is_saturated(report: Dict, slo_p95_s: float) -> bool:
+    """Un ritmo satura il sistema se il throughput non tiene il passo o la p95 sfora lo SLO."""
+    if report["timeouts"] or report["errors"]:
+        return True
+    if report["throughput"] < 0.9 * report["offered_rate"]:
+        return True
+    return report["p95"] is None or report["p95"] > slo_p95_s
+
+
+def run_sweep(args):
+    """Esegue run per ogni configurazione e ritmo in sottoprocessi separati."""
+    configs = args.config or [""]
+    rates = [float(r) for r in args.rates.split(",")]
+    results = []
+    for config in configs:
+        env = dict(os.environ)
+        env.update(dict(item.split("=", 1) for item in config.split(",") if item))
+        saturation = None
+        for rate in rates:
+            command = [
+                sys.executable, __file__, "run",
+                "--rate", str(rate), "--duration", str(args.duration),
+                "--mix", args.mix, "--drain-timeout", str(args.drain_timeout),
+                "--seed", str(args.seed),
+            ]
+            if args.update_template:
+                command += ["--update-template", args.update_template]
+            logger.info(f"Configurazione [{config or 'default'}], ritmo {rate} update/s")
+            # Il report passa da un file: lo stdout del processo figlio contiene anche i log
+            with tempfile.TemporaryDirectory(prefix="audiobot-sweep-") as temp_dir:
+                report_path = Path(temp_dir) / "report.json"
+                subprocess.run(command + ["--output", str(report_path)], env=env, capture_output=True, check=True)
+                report = json.loads(report_path.read_text())
+            results.append({"config": config or "default", "report": report})
+            print(f"[{config or 'default'}]\n{format_report(report)}\n")
+            if is_saturated(report, args.slo_p95):
+                saturation = rate
+                break
+        if saturation is None:
+            print(f"[{config or 'default'}] nessuna saturazione fino a {rates[-1]} update/s\n")
+        else:
+            print(f"[{config or 'default'}] saturazione a {saturation} update/s (p95 SLO {args.slo_p95}s)\n")
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test end-to-end del bot con Bot API finta")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_common(p):
+        p.add_argument("--duration", type=float, default=60, help="Secondi di invio del carico")
+        p.add_argument("--mix", default="5:0.7,40:0.2,600:0.1", help="Durate audio e pesi, es. 5:0.7,600:0.3")
+        p.add_argument("--drain-timeout", type=float, default=600, help="Secondi di attesa dei job in corso")
+        p.add_argument("--update-template", help="File JSON con un update Telegram di esempio")
+        p.add_argument("--seed", type=int, default=0)
+
+    run_parser = subparsers.add_parser("run", help="Singola esecuzione a ritmo costante")
+    add_common(run_parser)
+    run_parser.add_argument("--rate", type=float, default=1.0, help="Update al secondo")
+    run_parser.add_argument("--audio-dir", help="Cartella per i file audio generati")
+    run_parser.add_argument("--json", action="store_true", help="Stampa il report in JSON")
+    run_parser.add_argument("--output", help="File in cui scrivere il report in JSON")
+
+    sweep_parser = subparsers.add_parser("sweep", help="Ricerca del punto di saturazione")
+    add_common(sweep_parser)
+    sweep_parser.add_argument("--rates", default="0.5,1,2,4,8", help="Ritmi da provare, crescenti")
+    sweep_parser.add_argument("--config", action="append", help="Variabili d'ambiente KEY=VAL,... (ripetibile)")
+    sweep_parser.add_argument("--slo-p95", type=float, default=30.0, help="p95 massima accettabile (secondi)")
+    sweep_parser.add_argument("--output", help="File JSON con tutti i risultati")
+
+    args = parser.parse_args()
+    if args.command == "sweep":
+        run_sweep(args)
+        return
+
+    report = asyncio.run(run_load(args))
+    if args.output:
+        Path(args.output).write_text(json.dumps(report))
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print(format_report(report))
+
+
+if __name__ == "__main__":
+    main()
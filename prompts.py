@@ -22,4 +22,20 @@ Directives:
   Also, before adding a new line, finish the sentence.
 - try to identify when the speaker is reporting a dialogue, and add the correct punctuation.
 Transcription: {transcription}
-"""
\ No newline at end of file
+"""
+
+GEMINI_TRANSCRIPTION_PROMPT = """
+You are a helpful assistant that transcribes audio recordings in Italian.
+Transcribe the attached audio and return the punctuated transcription.
+Directives:
+- Do not change the meaning of what is said and do not translate it.
+- if you encounter a word which has no meaning, it may be due to a transcription error. 
+  In that case, leave it as it is, but try to find the correct word in the Italian language, and add it in parentheses immediately after the word.
+- after long paragraphs, add a new line. Remember to add a new line only after long paragraphs, not after every sentence.
+  Also, before adding a new line, finish the sentence.
+- try to identify when the speaker is reporting a dialogue, and add the correct punctuation.
+- if the audio contains no speech, return an empty transcription.
+{summary_directive}
+"""
+
+GEMINI_SUMMARY_DIRECTIVE = """- Also summarize the transcription in Italian in the summary field, with only the summary and no other text."""
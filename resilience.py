@@ -0,0 +1,340 @@
+"""
+Livello di chiamata resiliente attorno ai motori di trascrizione.
+
+Ogni chiamata a un motore passa da ResilientEngine, che applica:
+- una deadline per chunk (CHUNK_DEADLINE_S);
+- richieste duplicate "hedged" quando il primo tentativo supera il percentile
+  HEDGE_PERCENTILE delle latenze osservate su chunk di durata simile;
+- un numero limitato di retry con backoff esponenziale e jitter;
+- un circuit breaker che, dopo troppi fallimenti consecutivi, dirotta le
+  chiamate sul motore di fallback.
+
+I motori sono semplici callable sincroni ``engine(file_path, **kwargs)`` eseguiti
+in un thread, quindi si possono sostituire con un motore finto (vedi fakes.py).
+I thread vengono presi da un executor dedicato e limitato: un tentativo
+scaduto o battuto da una richiesta hedged non può essere interrotto, ma
+occupa solo quell'executor e non quello di default usato dal resto del bot.
+Deadline e hedging partono quando un thread prende in carico il tentativo,
+non quando viene accodato: l'attesa in coda non conta come guasto del motore.
+Un observer opzionale riceve l'esito di ogni tentativo (vedi autotune.py).
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import math
+import os
+import random
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional, Tuple, Type
+
+from logging_config import setup_logger
+
+# Configurazione del logger
+logger = setup_logger(__name__)
+
+CHUNK_DEADLINE_S = float(os.getenv("CHUNK_DEADLINE_S", "120"))
+CHUNK_MAX_RETRIES = int(os.getenv("CHUNK_MAX_RETRIES", "2"))
+RETRY_BACKOFF_BASE_S = float(os.getenv("RETRY_BACKOFF_BASE_S", "1"))
+RETRY_BACKOFF_MAX_S = float(os.getenv("RETRY_BACKOFF_MAX_S", "20"))
+# 0 disabilita l'hedging, altrimenti percentile (es. 95) delle latenze osservate
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+# Ampiezza (secondi di audio) delle fasce di durata con latenze separate per l'hedging
+HEDGE_BUCKET_S = 15
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT_S = float(os.getenv("CIRCUIT_RESET_TIMEOUT_S", "60"))
+
+Engine = Callable[..., Any]
+# observer(motore, durata_chunk_s, latenza_s, ok, chiamate_in_corso)
+AttemptObserver = Callable[[str, Optional[float], float, bool, int], None]
+
+
+class ChunkTimeoutError(TimeoutError):
+    """Il motore non ha risposto entro la deadline del chunk."""
+
+
+class CircuitOpenError(RuntimeError):
+    """Il circuit breaker è aperto e non è configurato un motore di fallback."""
+
+
+class LatencyTracker:
+    """Finestra mobile delle latenze osservate per un motore e una fascia di durata."""
+
+    def __init__(self, window: int = 200):
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def record(self, latency_s: float):
+        self._samples.append(latency_s)
+
+    def percentile(self, p: float, min_samples: int = 1) -> Optional[float]:
+        """Percentile p (0-100) delle latenze, o None se i campioni sono pochi."""
+        if len(self._samples) < max(min_samples, 1):
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker a tre stati (chiuso, aperto, semi-aperto).
+
+    Args:
+        failure_threshold: Fallimenti consecutivi che aprono il circuito
+        reset_timeout_s: Secondi dopo i quali si prova di nuovo il motore
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout_s: float = CIRCUIT_RESET_TIMEOUT_S,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    def allow(self) -> bool:
+        """Indica se la prossima chiamata può andare al motore protetto."""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout_s:
+            logger.info("Circuit breaker semi-aperto: provo di nuovo il motore principale")
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("Circuit breaker chiuso: il motore principale risponde di nuovo")
+        self.state = self.CLOSED
+        self._failures = 0
+        self._trial_in_flight = False
+
+    def release_trial(self):
+        """Libera la chiamata di prova semi-aperta interrotta senza esito (es. cancellata)."""
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self._failures += 1
+        self._trial_in_flight = False
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Circuit breaker aperto dopo {self._failures} fallimenti consecutivi")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+
+class ResilientEngine:
+    """
+    Esegue un motore di trascrizione con deadline, hedging, retry e fallback.
+
+    Args:
+        name: Nome del motore principale
+        engine: Callable sincrono che trascrive un file
+        fallback_name: Nome del motore di fallback (opzionale)
+        fallback: Callable del motore di fallback (opzionale)
+        non_retryable: Eccezioni per cui un nuovo tentativo è inutile
+        observer: Callable chiamato con l'esito di ogni tentativo
+        executor: Executor dedicato alle chiamate ai motori (default: quello del loop)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        engine: Engine,
+        fallback_name: Optional[str] = None,
+        fallback: Optional[Engine] = None,
+        deadline_s: float = CHUNK_DEADLINE_S,
+        max_retries: int = CHUNK_MAX_RETRIES,
+        backoff_base_s: float = RETRY_BACKOFF_BASE_S,
+        backoff_max_s: float = RETRY_BACKOFF_MAX_S,
+        hedge_percentile: float = HEDGE_PERCENTILE,
+        hedge_min_samples: int = HEDGE_MIN_SAMPLES,
+        breaker: Optional[CircuitBreaker] = None,
+        non_retryable: Tuple[Type[BaseException], ...] = (),
+        observer: Optional[AttemptObserver] = None,
+        executor: Optional[concurrent.futures.Executor] = None,
+    ):
+        self.name = name
+        self.engine = engine
+        self.fallback_name = fallback_name
+        self.fallback = fallback
+        self.deadline_s = deadline_s
+        self.max_retries = max_retries
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker or CircuitBreaker()
+        self.non_retryable = non_retryable
+        self.observer = observer
+        self.executor = executor
+        # Latenze per (motore, fascia di durata del chunk): un chunk breve non
+        # va confrontato con il percentile dei chunk lunghi
+        self.latencies: Dict[Tuple[str, Optional[int]], LatencyTracker] = {}
+        self.in_flight = {name: 0}
+        if fallback_name:
+            self.in_flight[fallback_name] = 0
+
+    def latency_tracker(self, name: str, duration_s: Optional[float]) -> LatencyTracker:
+        bucket = None if duration_s is None else math.ceil(duration_s / HEDGE_BUCKET_S)
+        return self.latencies.setdefault((name, bucket), LatencyTracker())
+
+    async def call(self, file_path: str, duration_s: Optional[float] = None, **engine_kwargs) -> Any:
+        """
+        Trascrive un file con il motore principale o, se necessario, con il fallback.
+        duration_s (durata del chunk) sceglie le latenze di riferimento per
+        l'hedging e viene passata all'observer;
+        engine_kwargs vengono passati al motore (principale o di fallback).
+        """
+        engine = functools.partial(self.engine, **engine_kwargs)
+        if self.breaker.allow():
+            try:
+                return await self._call_with_retries(self.name, engine, file_path, duration_s, self.breaker)
+            except self.non_retryable:
+                raise
+            except Exception as e:
+                if self.fallback is None:
+                    raise
+                logger.warning(f"Motore {self.name} fallito su {file_path} ({e}), uso il fallback {self.fallback_name}")
+        elif self.fallback is None:
+            raise CircuitOpenError(f"Circuit breaker aperto per il motore {self.name}")
+        else:
+            logger.info(f"Circuit breaker aperto, uso il motore di fallback {self.fallback_name} per {file_path}")
+        fallback = functools.partial(self.fallback, **engine_kwargs)
+        return await self._call_with_retries(self.fallback_name, fallback, file_path, duration_s, None)
+
+    async def _call_with_retries(
+        self, name: str, engine: Engine, file_path: str, duration_s: Optional[float],
+        breaker: Optional[CircuitBreaker],
+    ) -> Any:
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    result = await self._observed_attempt(name, engine, file_path, duration_s)
+                except self.non_retryable:
+                    if breaker is not None:
+                        # Il motore ha risposto: non è un guasto del servizio
+                        breaker.record_success()
+                    raise
+                except Exception as e:
+                    if breaker is not None:
+                        breaker.record_failure()
+                    if attempt == self.max_retries:
+                        raise
+                    # Backoff esponenziale con "full jitter"
+                    delay = random.uniform(0, min(self.backoff_max_s, self.backoff_base_s * 2 ** attempt))
+                    logger.warning(
+                        f"Tentativo {attempt + 1} con {name} fallito per {file_path}: {e}. "
+                        f"Nuovo tentativo tra {delay:.1f} secondi"
+                    )
+                    await asyncio.sleep(delay)
+                    if breaker is not None and not breaker.allow():
+                        raise
+                else:
+                    if breaker is not None:
+                        breaker.record_success()
+                    return result
+        except asyncio.CancelledError:
+            # Senza esito la prova semi-aperta resterebbe "in corso" per sempre
+            if breaker is not None:
+                breaker.release_trial()
+            raise
+
+    async def _observed_attempt(self, name: str, engine: Engine, file_path: str, duration_s: Optional[float]) -> Any:
+        """Esegue un tentativo e ne comunica latenza ed esito all'observer."""
+        loop = asyncio.get_running_loop()
+        self.in_flight[name] += 1
+        in_flight = self.in_flight[name]
+        start = loop.time()
+        ok = False
+        try:
+            result = await self._attempt(name, engine, file_path, duration_s)
+            ok = True
+            return result
+        except self.non_retryable:
+            # Il motore ha risposto correttamente, semplicemente senza testo
+            ok = True
+            raise
+        finally:
+            self.in_flight[name] -= 1
+            if self.observer is not None:
+                try:
+                    self.observer(name, duration_s, loop.time() - start, ok, in_flight)
+                except Exception as e:
+                    logger.warning(f"Errore nell'observer dei tentativi: {e}")
+
+    def _submit(self, engine: Engine, file_path: str) -> Tuple[asyncio.Future, asyncio.Future]:
+        """
+        Accoda il motore sull'executor. Restituisce il future del risultato e
+        un future che riceve l'istante (loop.time()) in cui un thread lo prende in carico.
+        """
+        loop = asyncio.get_running_loop()
+        started = loop.create_future()
+
+        def mark_started():
+            if not started.done():
+                started.set_result(loop.time())
+
+        def run():
+            try:
+                loop.call_soon_threadsafe(mark_started)
+            except RuntimeError:
+                # Loop già chiuso: il risultato verrebbe comunque ignorato
+                pass
+            return engine(file_path)
+
+        return loop.run_in_executor(self.executor, run), started
+
+    async def _attempt(self, name: str, engine: Engine, file_path: str, duration_s: Optional[float]) -> Any:
+        """Singolo tentativo con deadline ed eventuale richiesta duplicata."""
+        loop = asyncio.get_running_loop()
+        tracker = self.latency_tracker(name, duration_s)
+
+        # I thread abbandonati non si possono interrompere: ne ignoriamo il risultato
+        task, started = self._submit(engine, file_path)
+        pending = {task}
+        last_error = None
+        try:
+            # Deadline e hedging contano dall'avvio nel thread, non dall'accodamento
+            start = await started
+            deadline = start + self.deadline_s
+            hedge_at = None
+            if self.hedge_percentile:
+                hedge_delay = tracker.percentile(self.hedge_percentile, self.hedge_min_samples)
+                if hedge_delay is not None:
+                    hedge_at = start + hedge_delay
+            while pending:
+                wake_at = deadline if hedge_at is None else min(deadline, hedge_at)
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0.0, wake_at - loop.time()), return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        tracker.record(loop.time() - start)
+                        return task.result()
+                    last_error = task.exception()
+                if not pending:
+                    break
+                if loop.time() >= deadline:
+                    raise ChunkTimeoutError(f"{name} non ha risposto entro {self.deadline_s:.0f} secondi")
+                if hedge_at is not None and loop.time() >= hedge_at:
+                    logger.info(f"Richiesta hedged a {name} per {file_path} dopo {hedge_at - start:.1f} secondi")
+                    pending.add(self._submit(engine, file_path)[0])
+                    hedge_at = None
+            raise last_error
+        finally:
+            # Un tentativo ancora in coda viene tolto dall'executor
+            for task in pending:
+                task.cancel()
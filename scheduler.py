@@ -0,0 +1,151 @@
+"""
+Scheduler delle trascrizioni basato sulla durata dichiarata dei messaggi audio.
+
+Telegram comunica la durata di voice/audio prima del download: la usiamo per
+ordinare le richieste di trascrizione dei chunk con una coda multi-livello.
+
+- corsia veloce: note vocali sotto FAST_LANE_THRESHOLD_S secondi, con
+  SCHEDULER_FAST_LANE_SLOTS slot riservati che i job lunghi non possono occupare;
+- corsia normale: tutti gli altri job, in ordine shortest-job-first.
+
+Ogni chunk acquisisce uno slot separatamente, quindi un job lungo viene
+"preemptato" ai confini dei chunk: quando rilascia uno slot, le note brevi in
+attesa passano davanti ai suoi chunk successivi.
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+from logging_config import setup_logger
+
+# Configurazione del logger
+logger = setup_logger(__name__)
+
+FAST_LANE_THRESHOLD_S = float(os.getenv("FAST_LANE_THRESHOLD_S", "60"))
+SCHEDULER_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_MAX_CONCURRENCY", "8"))
+SCHEDULER_FAST_LANE_SLOTS = int(os.getenv("SCHEDULER_FAST_LANE_SLOTS", "2"))
+
+FAST_LANE = 0
+NORMAL_LANE = 1
+
+
+class TranscriptionScheduler:
+    """
+    Distribuisce un numero limitato di slot di trascrizione tra i job in attesa.
+
+    Args:
+        max_concurrency: Numero massimo di chunk in trascrizione contemporaneamente
+        fast_lane_slots: Slot riservati alla corsia veloce
+        fast_lane_threshold_s: Durata (secondi) sotto la quale un job è "breve"
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = SCHEDULER_MAX_CONCURRENCY,
+        fast_lane_slots: int = SCHEDULER_FAST_LANE_SLOTS,
+        fast_lane_threshold_s: float = FAST_LANE_THRESHOLD_S,
+    ):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency deve essere almeno 1")
+        if not 0 <= fast_lane_slots < max_concurrency:
+            raise ValueError("fast_lane_slots deve essere compreso tra 0 e max_concurrency - 1")
+        self.max_concurrency = max_concurrency
+        self.fast_lane_slots = fast_lane_slots
+        self.fast_lane_threshold_s = fast_lane_threshold_s
+        self._waiters: List[Tuple[int, float, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._in_flight = 0
+        self._normal_in_flight = 0
+
+    @property
+    def normal_lane_slots(self) -> int:
+        """Slot utilizzabili dalla corsia normale (quindi da ogni job diviso in chunk lunghi)."""
+        return self.max_concurrency - self.fast_lane_slots
+
+    def lane_for(self, declared_duration_s: Optional[float]) -> int:
+        """Restituisce la corsia per una durata dichiarata (sconosciuta = normale)."""
+        if declared_duration_s is not None and declared_duration_s < self.fast_lane_threshold_s:
+            return FAST_LANE
+        return NORMAL_LANE
+
+    def _can_grant(self, lane: int) -> bool:
+        if self._in_flight >= self.max_concurrency:
+            return False
+        if lane == NORMAL_LANE:
+            return self._normal_in_flight < self.normal_lane_slots
+        return True
+
+    def _grant(self, lane: int):
+        self._in_flight += 1
+        if lane == NORMAL_LANE:
+            self._normal_in_flight += 1
+
+    def _wake_waiters(self):
+        # La coda è ordinata per (corsia, durata, arrivo): se il primo in attesa
+        # non può partire, non può partire nessuno dietro di lui nella stessa
+        # corsia, e le corsie veloci sono sempre davanti.
+        while self._waiters:
+            lane, _, _, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if not self._can_grant(lane):
+                break
+            heapq.heappop(self._waiters)
+            self._grant(lane)
+            future.set_result(None)
+
+    async def acquire(self, declared_duration_s: Optional[float]) -> int:
+        """
+        Attende uno slot libero per un chunk del job con la durata indicata.
+
+        Returns:
+            int: La corsia assegnata, da passare a release()
+        """
+        lane = self.lane_for(declared_duration_s)
+        priority = declared_duration_s if declared_duration_s is not None else float("inf")
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (lane, priority, next(self._counter), future))
+        self._wake_waiters()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Lo slot era già stato assegnato: lo restituiamo
+                self.release(lane)
+            raise
+        return lane
+
+    def release(self, lane: int):
+        """Rilascia uno slot e lo assegna al job in attesa con priorità più alta."""
+        self._in_flight -= 1
+        if lane == NORMAL_LANE:
+            self._normal_in_flight -= 1
+        self._wake_waiters()
+
+    @asynccontextmanager
+    async def slot(self, declared_duration_s: Optional[float]):
+        """Context manager asincrono che occupa uno slot per la durata del blocco."""
+        lane = await self.acquire(declared_duration_s)
+        try:
+            yield lane
+        finally:
+            self.release(lane)
+
+    def snapshot(self) -> Dict[str, int]:
+        """Stato corrente dello scheduler, utile per log e metriche."""
+        waiting = [w for w in self._waiters if not w[3].done()]
+        return {
+            "in_flight": self._in_flight,
+            "normal_in_flight": self._normal_in_flight,
+            "waiting_fast": sum(1 for w in waiting if w[0] == FAST_LANE),
+            "waiting_normal": sum(1 for w in waiting if w[0] == NORMAL_LANE),
+        }
+
+
+# Scheduler condiviso da tutte le richieste del processo
+SCHEDULER = TranscriptionScheduler()
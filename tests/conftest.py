@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# I moduli del bot sono al primo livello del repository
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,48 @@
+"""
+Test del piano di chunking scelto dall'autotuner.
+"""
+
+import autotune
+from autotune import Autotuner, chunking_plan, plan_options
+from scheduler import TranscriptionScheduler
+
+
+def make_autotuner(tmp_path) -> Autotuner:
+    return Autotuner(state_path=tmp_path / "autotune.json", max_concurrency=8, explore=0.0)
+
+
+def test_short_audio_is_never_split(tmp_path):
+    autotuner = make_autotuner(tmp_path)
+    for duration in (5, 30, autotune.BASELINE_CHUNK_S):
+        plan = autotuner.plan("google-legacy", duration, **plan_options("google-legacy"))
+        assert plan.n_chunks == 1
+
+
+def test_concurrency_is_capped_at_normal_lane_slots(tmp_path):
+    scheduler = TranscriptionScheduler(max_concurrency=8, fast_lane_slots=2)
+    autotuner = make_autotuner(tmp_path)
+    options = plan_options("google-legacy", max_concurrency=scheduler.normal_lane_slots)
+    plans = autotuner.candidate_plans("google-legacy", 3600, **options)
+    assert max(plan.concurrency for plan in plans) == 6
+
+
+def test_fallback_limits_chunk_length(monkeypatch, tmp_path):
+    monkeypatch.setattr(autotune, "AUTOTUNER", make_autotuner(tmp_path))
+    assert chunking_plan("gemini", 3600).chunk_s > 60
+    assert chunking_plan("gemini", 3600, fallback_engine="google-legacy").chunk_s <= 60
+
+
+def test_disabled_autotune_uses_baseline(monkeypatch):
+    monkeypatch.setattr(autotune, "AUTOTUNE_ENABLED", False)
+    plan = chunking_plan("gemini", 3600, max_concurrency=6)
+    assert plan.chunk_s == autotune.CHUNK_DURATION_MS / 1000
+    assert plan.concurrency == 6
+
+
+def test_save_merges_samples_from_other_processes(tmp_path):
+    first, second = make_autotuner(tmp_path), make_autotuner(tmp_path)
+    first.record("fake", 30.0, 1.0, True)
+    second.record("fake", 30.0, 2.0, True)
+    first.save()
+    second.save()
+    assert len(make_autotuner(tmp_path).stats("fake").samples) == 2
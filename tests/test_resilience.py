@@ -0,0 +1,199 @@
+"""
+Test di scheduler e chiamate resilienti, pilotati con il motore finto di fakes.py.
+"""
+
+import asyncio
+import concurrent.futures
+
+import pytest
+
+from fakes import FakeEngine, FakeEngineError
+from resilience import ChunkTimeoutError, CircuitBreaker, CircuitOpenError, ResilientEngine
+from scheduler import FAST_LANE, NORMAL_LANE, TranscriptionScheduler
+
+
+def make_engine(engine, **kwargs) -> ResilientEngine:
+    options = {"deadline_s": 1.0, "max_retries": 0, "backoff_base_s": 0.0, "backoff_max_s": 0.0}
+    options.update(kwargs)
+    return ResilientEngine("fake", engine, **options)
+
+
+def test_deadline_raises_chunk_timeout():
+    engine = FakeEngine(hang_rate=1.0, hang_s=0.5)
+    resilient = make_engine(engine, deadline_s=0.1)
+    with pytest.raises(ChunkTimeoutError):
+        asyncio.run(resilient.call("chunk.wav"))
+
+
+def test_retries_until_success():
+    calls = []
+
+    def flaky(file_path):
+        calls.append(file_path)
+        if len(calls) < 3:
+            raise FakeEngineError("errore iniettato")
+        return "ok"
+
+    resilient = make_engine(flaky, max_retries=2)
+    assert asyncio.run(resilient.call("chunk.wav")) == "ok"
+    assert len(calls) == 3
+
+
+def test_non_retryable_is_not_retried():
+    engine = FakeEngine(latency_s=0.0, error_rate=1.0, seed=1)
+    resilient = make_engine(engine, max_retries=3, non_retryable=(FakeEngineError,))
+    with pytest.raises(FakeEngineError):
+        asyncio.run(resilient.call("chunk.wav"))
+    assert engine.calls == 1
+
+
+def test_hedged_request_beats_hung_attempt():
+    async def run():
+        engine = FakeEngine(latency_s=0.01, hang_rate=0.1, hang_s=0.5, seed=1)
+        resilient = make_engine(engine, deadline_s=2.0, hedge_percentile=90, hedge_min_samples=5)
+        latencies = []
+        loop = asyncio.get_running_loop()
+        for i in range(40):
+            start = loop.time()
+            await resilient.call(f"chunk-{i}.wav", duration_s=30)
+            latencies.append(loop.time() - start)
+        return engine, latencies
+
+    engine, latencies = asyncio.run(run())
+    # Dopo i primi campioni, i blocchi vengono superati da una richiesta duplicata
+    assert max(latencies[10:]) < 0.4
+    assert engine.calls > 40
+
+
+def test_hedge_latencies_are_kept_per_chunk_length():
+    async def run():
+        resilient = make_engine(FakeEngine(latency_s=0.0), hedge_percentile=95)
+        await resilient.call("long.wav", duration_s=60)
+        await resilient.call("short.wav", duration_s=5)
+        return resilient
+
+    resilient = asyncio.run(run())
+    assert len(resilient.latencies) == 2
+
+
+def test_deadline_starts_when_a_thread_picks_up_the_attempt():
+    async def run():
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        engine = FakeEngine(latency_s=0.2)
+        resilient = make_engine(engine, deadline_s=0.3, executor=executor)
+        # Il secondo chunk attende 0.2 s in coda: non deve scadere per questo
+        results = await asyncio.gather(resilient.call("a.wav"), resilient.call("b.wav"))
+        executor.shutdown()
+        return engine, results
+
+    engine, results = asyncio.run(run())
+    assert results == ["Trascrizione di prova."] * 2
+    assert engine.calls == 2
+
+
+def test_queued_retries_reach_the_engine():
+    async def run():
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        calls = []
+
+        def engine(file_path):
+            calls.append(file_path)
+            if len(calls) <= 2:
+                # I primi due tentativi restano bloccati e occupano entrambi i thread
+                FakeEngine(hang_rate=1.0, hang_s=0.6)(file_path)
+            return "ok"
+
+        resilient = make_engine(engine, deadline_s=0.2, max_retries=1, executor=executor)
+        results = await asyncio.gather(resilient.call("a.wav"), resilient.call("b.wav"))
+        executor.shutdown()
+        return calls, results
+
+    calls, results = asyncio.run(run())
+    assert results == ["ok", "ok"]
+    assert len(calls) == 4
+
+
+def test_breaker_opens_and_uses_fallback():
+    primary = FakeEngine(latency_s=0.0, error_rate=1.0, seed=1)
+    fallback = FakeEngine(latency_s=0.0, text="fallback")
+    resilient = make_engine(
+        primary, fallback_name="fallback", fallback=fallback,
+        breaker=CircuitBreaker(failure_threshold=2, reset_timeout_s=60),
+    )
+
+    async def run():
+        return [await resilient.call(f"chunk-{i}.wav") for i in range(4)]
+
+    assert asyncio.run(run()) == ["fallback"] * 4
+    assert resilient.breaker.state == CircuitBreaker.OPEN
+    assert primary.calls == 2
+
+
+def test_open_breaker_without_fallback_raises():
+    resilient = make_engine(FakeEngine(latency_s=0.0, error_rate=1.0, seed=1),
+                            breaker=CircuitBreaker(failure_threshold=1, reset_timeout_s=60))
+
+    async def run():
+        with pytest.raises(FakeEngineError):
+            await resilient.call("a.wav")
+        with pytest.raises(CircuitOpenError):
+            await resilient.call("b.wav")
+
+    asyncio.run(run())
+
+
+def test_cancelled_half_open_trial_is_released():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout_s=0.0)
+    engine = FakeEngine(latency_s=0.0)
+    resilient = make_engine(FakeEngine(hang_rate=1.0, hang_s=0.3), breaker=breaker)
+
+    async def run():
+        breaker.record_failure()
+        trial = asyncio.ensure_future(resilient.call("trial.wav"))
+        await asyncio.sleep(0.05)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        # La prova cancellata non deve bloccare il circuito semi-aperto
+        resilient.engine = engine
+        return await resilient.call("next.wav")
+
+    assert asyncio.run(run()) == "Trascrizione di prova."
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert engine.calls == 1
+
+
+def test_scheduler_reserves_fast_lane_slots():
+    async def run():
+        scheduler = TranscriptionScheduler(max_concurrency=3, fast_lane_slots=1, fast_lane_threshold_s=60)
+        normal = [await scheduler.acquire(600) for _ in range(2)]
+        blocked = asyncio.ensure_future(scheduler.acquire(600))
+        fast = await asyncio.wait_for(scheduler.acquire(10), timeout=1)
+        await asyncio.sleep(0)
+        snapshot = scheduler.snapshot()
+        blocked.cancel()
+        return normal, fast, snapshot
+
+    normal, fast, snapshot = asyncio.run(run())
+    assert normal == [NORMAL_LANE, NORMAL_LANE]
+    assert fast == FAST_LANE
+    assert snapshot["waiting_normal"] == 1
+
+
+def test_scheduler_serves_short_jobs_first():
+    async def run():
+        scheduler = TranscriptionScheduler(max_concurrency=2, fast_lane_slots=1, fast_lane_threshold_s=60)
+        order = []
+
+        async def job(duration):
+            async with scheduler.slot(duration):
+                order.append(duration)
+                await asyncio.sleep(0.01)
+
+        async with scheduler.slot(600):
+            tasks = [asyncio.ensure_future(job(d)) for d in (900, 300, 120)]
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == [120, 300, 900]